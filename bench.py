@@ -0,0 +1,399 @@
+# Offline load test for the salary bot
+# Imports the command callbacks from "bot dis2.py" and drives them with stub Discord objects
+# against a temporary copy of the database, no Discord connection needed.
+#
+#   python bench.py --users 500 --history 200000 --workload adders --concurrency 50
+#   python bench.py --workload all --output bench_results.json --compare old_results.json
+#   python bench.py --workload adders --guilds 4   # members spread over 4 guilds, one database each
+#   python bench.py --workload adders --backup     # a full online backup runs during each workload
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BOT_FILE = os.path.join(HERE, 'bot dis2.py')
+ADMIN_ROLE = 1202583369708474368
+STAFF_ROLE = 1203246669630672906
+FIRST_USER_ID = 10 ** 17
+FIRST_GUILD_ID = 1
+
+
+# Stub Discord objects, sends are recorded instead of going to the network
+class FakeMessage:
+    def __init__(self, content=None, embed=None):
+        self.content = content
+        self.embed = embed
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeMember:
+    def __init__(self, member_id, guild, roles):
+        self.id = member_id
+        self.guild = guild
+        self.roles = roles
+        self.mention = f'<@{member_id}>'
+        self.display_name = f'user{member_id - FIRST_USER_ID}'
+        self.name = self.display_name
+        self.bot = False
+        self.guild_permissions = SimpleNamespace(manage_messages=True, administrator=False)
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(content, kwargs.get('embed'))
+
+
+class FakeGuild:
+    def __init__(self, guild_id, role_count):
+        self.id = guild_id
+        self.roles = [SimpleNamespace(id=i) for i in range(1, role_count)]
+        self.roles += [SimpleNamespace(id=ADMIN_ROLE), SimpleNamespace(id=STAFF_ROLE)]
+        self.members = {}
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    def get_member_named(self, name):
+        return next((m for m in self.members.values() if m.display_name == name), None)
+
+
+class FakeContext:
+    def __init__(self, guild, author, content='', attachments=()):
+        self.guild = guild
+        self.author = author
+        self.message = SimpleNamespace(content=content, attachments=list(attachments))
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(content, kwargs.get('embed'))
+
+
+class FakeClient:
+    # Stands in for the bot in the outbox dispatcher
+    def __init__(self, guild):
+        self.guild = guild
+
+    async def wait_until_ready(self):
+        pass
+
+    def get_user(self, user_id):
+        return self.guild.get_member(user_id)
+
+    async def fetch_user(self, user_id):
+        return self.guild.get_member(user_id)
+
+
+def load_bot(db_path):
+    # The bot reads its database path from the environment at import time; the copied
+    # database belongs to the first fake guild, the others get new files next to it
+    os.environ['BOT_DB_PATH'] = db_path
+    os.environ['BOT_LEGACY_GUILD_ID'] = str(FIRST_GUILD_ID)
+    # Backups only run when asked for with --backup
+    os.environ['BOT_BACKUP_INTERVAL'] = '0'
+    spec = importlib.util.spec_from_file_location('salary_bot', BOT_FILE)
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+
+def seed(conn, user_ids, history_rows, rng):
+    # Spread history over the last two years, balances match the sum of each user's history
+    now = int(time.time())
+    balances = dict.fromkeys(user_ids, 0.0)
+    rows = []
+    timestamps = sorted(rng.randrange(now - 730 * 86400, now) for _ in range(history_rows))
+    for timestamp in timestamps:
+        user_id = rng.choice(user_ids)
+        amount = float(rng.choice((1, 2, 5, 10, 20, -1, -5)))
+        balances[user_id] += amount
+        dt = time.localtime(timestamp)
+        rows.append((user_id, timestamp, amount, 'add' if amount > 0 else 'minus', ADMIN_ROLE,
+                     balances[user_id], dt.tm_year * 100 + dt.tm_mon))
+    conn.executemany(
+        'INSERT INTO salary_history (user_id, timestamp, amount, command, executor, current_salary, month) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.executemany(
+        'INSERT INTO user_points (user_id, points) VALUES (?, ?) '
+        'ON CONFLICT (user_id) DO UPDATE SET points = points + excluded.points',
+        list(balances.items()))
+
+
+class LoopMonitor:
+    # Measures how long the event loop is blocked: a task asks to wake every interval and records the overshoot
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def report(self):
+        if not self.lags:
+            return {'samples': 0}
+        return {
+            'samples': len(self.lags),
+            'max_ms': max(self.lags) * 1000,
+            'p99_ms': percentile(self.lags, 99) * 1000,
+            'blocked_ms': sum(lag for lag in self.lags if lag > 0.001) * 1000,
+        }
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed):
+    if not latencies:
+        return {'count': 0}
+    return {
+        'count': len(latencies),
+        'throughput_per_s': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': statistics.fmean(latencies) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000,
+    }
+
+
+async def invoke(bot, command, ctx, *args, **kwargs):
+    # Run the command's checks (roles, permissions), charge its rate limit like before_invoke does, then run its callback
+    ctx.command = command
+    for check in command.checks:
+        if not await bot.discord.utils.maybe_coroutine(check, ctx):
+            raise bot.commands.CheckFailure(command.name)
+    try:
+        bot.charge_rate_limit(ctx)
+    except bot.Spamming:
+        # Throttled calls are counted by the rate limiter and reported with the results
+        return
+    await command.callback(ctx, *args, **kwargs)
+
+
+async def timed_calls(calls, concurrency):
+    # calls: list of zero-argument coroutine functions; returns latency of each
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(call):
+        async with semaphore:
+            started = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(run(call) for call in calls))
+    return latencies
+
+
+def workload_adders(bot, guild, admin, members, args, rng):
+    month = bot.current_month_key()
+
+    def call(member, amount):
+        command = bot.add_points if amount >= 0 else bot.minus_points
+        return lambda: invoke(bot, command, FakeContext(guild, admin), member, abs(amount), month)
+
+    return [call(rng.choice(members), rng.choice((1, 2, 5, -1))) for _ in range(args.ops)]
+
+
+def workload_viewers(bot, guild, admin, members, args, rng):
+    def call(member):
+        return lambda: invoke(bot, bot.view_salary_history, FakeContext(guild, admin), member)
+
+    return [call(rng.choice(members)) for _ in range(args.ops)]
+
+
+def workload_bulk(bot, guild, admin, members, args, rng):
+    def call():
+        lines = [f'{member.mention} {rng.choice((50, 100, 200))}' for member in rng.sample(members, min(args.bulk_size, len(members)))]
+        body = '\n'.join(lines)
+        return lambda: invoke(bot, bot.bulk_payroll, FakeContext(guild, admin), body=body)
+
+    return [call() for _ in range(max(1, args.ops // args.bulk_size))]
+
+
+def workload_undo(bot, guild, admin, members, args, rng):
+    # Another admin's add is undone, redone and undone again with !undo_by/!redo_by, so balances end unchanged
+    month = bot.current_month_key()
+
+    def call(executor, member):
+        async def run():
+            await invoke(bot, bot.add_points, FakeContext(guild, executor), member, 5, month)
+            for command in (bot.undo_by_executor, bot.redo_by_executor, bot.undo_by_executor):
+                await invoke(bot, command, FakeContext(guild, admin), executor)
+        return run
+
+    # One executor per cycle, so concurrent cycles never undo each other's operations
+    return [call(FakeMember(admin.id - 1 - i, guild, admin.roles), rng.choice(members)) for i in range(max(1, args.ops // 4))]
+
+
+def workload_mixed(bot, guild, admin, members, args, rng):
+    calls = workload_adders(bot, guild, admin, members, args, rng)[:args.ops * 8 // 10]
+    calls += workload_viewers(bot, guild, admin, members, args, rng)[:args.ops * 2 // 10]
+    rng.shuffle(calls)
+    return calls
+
+
+WORKLOADS = {
+    'adders': workload_adders,
+    'viewers': workload_viewers,
+    'bulk': workload_bulk,
+    'mixed': workload_mixed,
+    'undo': workload_undo,
+}
+# Workloads that must leave every balance as it was, checked after they run
+BALANCE_NEUTRAL = {'undo'}
+
+
+def balances(conn):
+    return dict(conn.execute('SELECT user_id, points FROM user_points'))
+
+
+async def run_benchmark(bot, args):
+    rng = random.Random(args.seed)
+    # Users, history and commands are split evenly over the guilds
+    tenant_args = argparse.Namespace(**{**vars(args), 'ops': max(1, args.ops // args.guilds)})
+    tenants = []
+    seed_time = 0.0
+    for g in range(args.guilds):
+        guild = FakeGuild(FIRST_GUILD_ID + g, args.roles)
+        admin_roles = [role for role in guild.roles if role.id in (ADMIN_ROLE, STAFF_ROLE)]
+        admin = FakeMember(FIRST_USER_ID - 1, guild, admin_roles)
+        members = [FakeMember(FIRST_USER_ID + i, guild, guild.roles[:3]) for i in range(g, args.users, args.guilds)]
+        guild.members = {member.id: member for member in members + [admin]}
+        tenants.append((guild, admin, members))
+
+        store = await bot.get_store(guild.id, FakeClient(guild))
+        started = time.perf_counter()
+        await store.db.write(seed, [member.id for member in members], args.history // args.guilds, rng)
+        await bot.rebuild_monthly_totals(guild.id)
+        seed_time += time.perf_counter() - started
+        await bot.warm_balance_cache(guild.id)
+        if not args.rate_limit:
+            bot.configs[guild.id].rate_limits.clear()
+
+    names = list(WORKLOADS) if args.workload == 'all' else [args.workload]
+    results = {}
+    for name in names:
+        calls = []
+        for guild, admin, members in tenants:
+            calls += WORKLOADS[name](bot, guild, admin, members, tenant_args, rng)
+        rng.shuffle(calls)
+        before = [await bot.stores[guild.id].db.read(balances) for guild, _, _ in tenants] if name in BALANCE_NEUTRAL else None
+        monitor = LoopMonitor()
+        monitor.start()
+        started = time.perf_counter()
+        backups = [asyncio.ensure_future(bot.backup_now(guild.id)) for guild, _, _ in tenants] if args.backup else []
+        latencies = await timed_calls(calls, args.concurrency)
+        elapsed = time.perf_counter() - started
+        await asyncio.gather(*backups)
+        await monitor.stop()
+        results[name] = {'latency': summarize(latencies, elapsed), 'loop': monitor.report(), 'elapsed_s': elapsed}
+        if before is not None:
+            for (guild, _, _), old in zip(tenants, before):
+                new = await bot.stores[guild.id].db.read(balances)
+                changed = [user_id for user_id in new if abs(new[user_id] - old.get(user_id, 0.0)) > 0.000001]
+                if changed:
+                    raise RuntimeError(f'{name}: {len(changed)} balances changed in guild {guild.id}')
+        if args.backup:
+            results[name]['backup_s'] = time.perf_counter() - started
+        print(f"{name:8} {results[name]['latency']['count']:6} calls  "
+              f"{results[name]['latency']['throughput_per_s']:9.1f}/s  "
+              f"p50 {results[name]['latency']['p50_ms']:7.2f} ms  "
+              f"p95 {results[name]['latency']['p95_ms']:7.2f} ms  "
+              f"p99 {results[name]['latency']['p99_ms']:7.2f} ms  "
+              f"loop max {results[name]['loop'].get('max_ms', 0):6.2f} ms")
+
+    stats = {}
+    for guild, _, _ in tenants:
+        store = bot.stores[guild.id]
+        await store.write_queue.close()
+        stats[guild.id] = store.stats()
+    for guild, _, _ in tenants:
+        await bot.close_store(guild.id)
+    return {
+        'seed_s': seed_time,
+        'workloads': results,
+        'guilds': stats,
+        'rate_limiter': bot.rate_limiter.stats(),
+    }
+
+
+def compare(previous, current):
+    # Print the change of each workload's throughput and tail latency against an earlier run
+    for name, result in current['workloads'].items():
+        before = previous.get('workloads', {}).get(name)
+        if not before or not before['latency'].get('count'):
+            continue
+        for key in ('throughput_per_s', 'p50_ms', 'p95_ms', 'p99_ms'):
+            old, new = before['latency'][key], result['latency'][key]
+            change = (new - old) / old * 100 if old else 0.0
+            print(f"{name:8} {key:17} {old:10.2f} -> {new:10.2f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test for the salary bot')
+    parser.add_argument('--workload', choices=list(WORKLOADS) + ['all'], default='all')
+    parser.add_argument('--users', type=int, default=300, help='members to seed')
+    parser.add_argument('--history', type=int, default=50000, help='history rows to seed')
+    parser.add_argument('--roles', type=int, default=300, help='roles in each fake guild')
+    parser.add_argument('--guilds', type=int, default=1, help='guilds to spread the users over')
+    parser.add_argument('--ops', type=int, default=2000, help='commands per workload')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--bulk-size', type=int, default=300, help='lines per !bulk run')
+    parser.add_argument('--rate-limit', action='store_true', help='keep the per-user rate limits enabled')
+    parser.add_argument('--backup', action='store_true', help='run an online backup of every guild during each workload')
+    parser.add_argument('--database', default=os.path.join(HERE, 'bot_data.db'), help='database to copy; "none" starts empty')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='botbench-')
+    db_path = os.path.join(workdir, 'bot_data.db')
+    if args.database != 'none':
+        shutil.copy(args.database, db_path)
+    try:
+        bot = load_bot(db_path)
+        results = asyncio.run(run_benchmark(bot, args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results['config'] = vars(args)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
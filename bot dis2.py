@@ -1,10 +1,27 @@
 import discord
 from discord.ext import commands
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import sqlite3
 import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import math
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import time
+import typing
+from collections import OrderedDict
 
 
+log = logging.getLogger(__name__)
+
 # Intents
 intents = discord.Intents.default()
 intents.messages = True
@@ -12,73 +29,1937 @@ intents.guilds = True
 intents.members = True
 intents.message_content = True
 
+# Sharding: with BOT_SHARD_COUNT and BOT_SHARD_IDS (e.g. "0,1") each process runs only some shards,
+# and so only ever opens the databases of the guilds on those shards
+SHARD_COUNT = int(os.environ['BOT_SHARD_COUNT']) if os.environ.get('BOT_SHARD_COUNT') else None
+SHARD_IDS = [int(i) for i in os.environ['BOT_SHARD_IDS'].split(',')] if os.environ.get('BOT_SHARD_IDS') else None
+DEFAULT_PREFIX = '!'
+
+
+# The prefix is part of each guild's configuration; reading it never opens the guild's store
+async def get_prefix(bot, message):
+    if message.guild is None:
+        return DEFAULT_PREFIX
+    config = await get_config(message.guild.id)
+    return config.prefix
+
+
 # Create bot instance with intents
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot = commands.AutoShardedBot(command_prefix=get_prefix, intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
 bot.remove_command('help')
 bot.help_command = commands.DefaultHelpCommand(no_category='Commands')
 
-# Connect to SQLite database
-conn = sqlite3.connect('bot_data.db')
-cursor = conn.cursor()
-
-# Create a table for user points
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS user_points (
-        user_id INTEGER PRIMARY KEY,
-        points REAL
-    )
-''')
-
-
-# Create a table for salary history
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS salary_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        timestamp TEXT,
-        amount REAL,
-        command TEXT,
-        executor INTEGER,
-        current_salary REAL,
-        month TEXT,  -- Thêm cột mới để lưu trữ tháng
-        FOREIGN KEY (user_id) REFERENCES user_points(user_id)
-    )
-''')
-
-
-conn.commit()
-
-# Function to add or subtract points and update history
-def update_points(user_id, amount, command, executor_id, target_month):
-    current_month = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    # Insert or update user points in the database
-    cursor.execute('INSERT OR IGNORE INTO user_points (user_id, points) VALUES (?, ?)', (user_id, 0.0))
-    cursor.execute('UPDATE user_points SET points = points + ? WHERE user_id = ?', (amount, user_id))
+# Telemetry
+# Latencies are kept in fixed-size ring buffers (the last METRICS_WINDOW samples of each
+# command/query) plus running count and sum, so recording one costs about a microsecond.
+METRICS_WINDOW = int(os.environ.get('BOT_METRICS_WINDOW', 1024))
+METRICS_PORT = int(os.environ.get('BOT_METRICS_PORT', 0))  # 0 = no HTTP endpoint
+LOOP_LAG_INTERVAL = 0.5
+
+
+class RingStats:
+    __slots__ = ('samples', 'index', 'count', 'total', 'max')
+
+    def __init__(self, size=METRICS_WINDOW):
+        self.samples = [0.0] * size
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        # Not locked: DB threads may race here, at worst one sample in the window is lost
+        self.samples[self.index] = value
+        self.index = (self.index + 1) % len(self.samples)
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantiles(self, *qs):
+        window = sorted(self.samples[:self.count] if self.count < len(self.samples) else self.samples)
+        if not window:
+            return [0.0] * len(qs)
+        return [window[min(len(window) - 1, int(q * len(window)))] for q in qs]
+
+
+class Telemetry:
+    def __init__(self):
+        self.commands = {}  # command name -> RingStats of seconds
+        self.queries = {}  # (kind, query) -> RingStats of seconds spent running
+        self.query_wait = {}  # (kind, query) -> RingStats of seconds queued for a DB thread
+        self.rows = {}  # (kind, query) -> rows returned
+        self.vm_steps = {}  # (kind, query) -> SQLite VM instructions, a proxy for rows scanned
+        self.commits = 0
+        self.rollbacks = 0
+        self.loop_lag = RingStats()
+        self.started = time.time()
+        self._lag_task = None
+
+    def _stats(self, table, key):
+        stats = table.get(key)
+        if stats is None:
+            stats = table[key] = RingStats()
+        return stats
+
+    def record_command(self, name, seconds):
+        self._stats(self.commands, name).add(seconds)
+
+    def record_query(self, kind, name, waited, seconds, result, steps):
+        key = (kind, name)
+        self._stats(self.queries, key).add(seconds)
+        self._stats(self.query_wait, key).add(waited)
+        if isinstance(result, list):
+            self.rows[key] = self.rows.get(key, 0) + len(result)
+        self.vm_steps[key] = self.vm_steps.get(key, 0) + steps
+
+    async def _sample_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag.add(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._lag_task = asyncio.get_running_loop().create_task(self._sample_loop_lag())
+
+
+telemetry = Telemetry()
+
+
+# Database layer
+# Every query runs off the event loop: one dedicated writer thread owns the only
+# write connection, and a small pool of reader threads each keep their own
+# connection. WAL mode lets the readers run while the writer commits.
+DB_READERS = int(os.environ.get('BOT_DB_READERS', 4))
+
+
+class Database:
+    def __init__(self, path, readers=DB_READERS, archive_path=None):
+        self.path = path
+        # Closed months are moved to a separate file, attached to every connection as "archive"
+        self.archive_path = archive_path or os.path.splitext(path)[0] + '.archive.db'
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+
+    def _connection(self):
+        # One connection per thread, opened lazily the first time the thread runs a job
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+            conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+            conn.execute('PRAGMA archive.journal_mode=WAL')
+            self._local.conn = conn
+            self._local.steps = 0
+            local = self._local
+
+            def count_steps():
+                local.steps += 1000
+                return 0
+            conn.set_progress_handler(count_steps, 1000)
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _run_read(self, fn, args, queued):
+        conn = self._connection()
+        steps = self._local.steps
+        started = time.perf_counter()
+        result = fn(conn, *args)
+        telemetry.record_query('read', fn.__name__, started - queued, time.perf_counter() - started, result, self._local.steps - steps)
+        return result
+
+    def _run_write(self, fn, args, queued):
+        conn = self._connection()
+        steps = self._local.steps
+        started = time.perf_counter()
+        callbacks = self._local.after_commit = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(conn, *args)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            telemetry.rollbacks += 1
+            raise
+        conn.execute('COMMIT')
+        telemetry.commits += 1
+        telemetry.record_query('write', fn.__name__, started - queued, time.perf_counter() - started, result, self._local.steps - steps)
+        for callback in callbacks:
+            callback()
+        return result
+
+    def after_commit(self, callback):
+        # Only valid inside a write; callback runs on the writer thread once the transaction has committed
+        self._local.after_commit.append(callback)
+
+    async def read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run_read, fn, args, time.perf_counter())
+
+    async def write(self, fn, *args):
+        # fn runs inside a single transaction on the writer thread
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._run_write, fn, args, time.perf_counter())
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+
+# Write-through cache of user balances
+# Only the writer thread changes balances, and it refreshes the cache after each commit,
+# so a cached value is always the committed balance.
+BALANCE_CACHE_SIZE = int(os.environ.get('BOT_BALANCE_CACHE_SIZE', 10000))
+
+
+class BalanceCache:
+    def __init__(self, capacity=BALANCE_CACHE_SIZE):
+        self.capacity = capacity
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            balance = self._data.get(user_id)
+            if balance is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return balance
+
+    def set(self, user_id, balance):
+        with self._lock:
+            self._data[user_id] = balance
+            self._data.move_to_end(user_id)
+            if len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+
+# Months are stored as an integer key YYYYMM and timestamps as epoch seconds
+MONTH_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d', '%Y-%m', '%m/%Y', '%m-%Y', '%Y%m')
+
+
+def month_key(dt):
+    return dt.year * 100 + dt.month
+
+
+def current_month_key():
+    return month_key(datetime.now())
+
+
+def parse_month(text):
+    # Used as a command converter, e.g. "2024-02", "02/2024" or an old-style full timestamp
+    for fmt in MONTH_FORMATS:
+        try:
+            return month_key(datetime.strptime(text.strip(), fmt))
+        except ValueError:
+            pass
+    raise commands.BadArgument(f'Tháng không hợp lệ: {text}')
+
+
+def parse_amount(text):
+    # Used as a command converter for amounts; float() alone accepts "nan" and "inf"
+    try:
+        amount = float(text)
+    except ValueError:
+        raise commands.BadArgument(f'Số tiền không hợp lệ: {text}')
+    if not math.isfinite(amount):
+        raise commands.BadArgument(f'Số tiền không hợp lệ: {text}')
+    return amount
+
+
+def format_month(key):
+    return f'tháng {key % 100:02d} {key // 100}'
+
+
+def _legacy_epoch(text):
+    try:
+        return int(datetime.strptime(text, '%Y-%m-%d %H:%M:%S').timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def _legacy_month(text, fallback):
+    try:
+        return parse_month(text)
+    except (AttributeError, commands.BadArgument):
+        return month_key(datetime.fromtimestamp(fallback))
+
+
+# Schema migrations
+# Each step runs in its own transaction and bumps PRAGMA user_version, so a
+# database is brought up to date in place whatever version it was left at.
+def migration_create_tables(conn):
+    # Create a table for user points
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_points (
+            user_id INTEGER PRIMARY KEY,
+            points REAL
+        )
+    ''')
+
+    # Create a table for salary history
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS salary_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            timestamp TEXT,
+            amount REAL,
+            command TEXT,
+            executor INTEGER,
+            current_salary REAL,
+            month TEXT,  -- Thêm cột mới để lưu trữ tháng
+            FOREIGN KEY (user_id) REFERENCES user_points(user_id)
+        )
+    ''')
+
+
+def migration_typed_history(conn):
+    # TEXT timestamps/months -> epoch seconds and YYYYMM, plus per-user indexes
+    conn.create_function('legacy_epoch', 1, _legacy_epoch, deterministic=True)
+    conn.create_function('legacy_month', 2, _legacy_month, deterministic=True)
+    conn.execute('''
+        CREATE TABLE salary_history_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,  -- epoch seconds
+            amount REAL NOT NULL,
+            command TEXT NOT NULL,
+            executor INTEGER,
+            current_salary REAL,
+            month INTEGER NOT NULL,  -- YYYYMM
+            FOREIGN KEY (user_id) REFERENCES user_points(user_id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO salary_history_new (id, user_id, timestamp, amount, command, executor, current_salary, month)
+        SELECT id, user_id, legacy_epoch(timestamp), amount, command, executor, current_salary,
+               legacy_month(month, legacy_epoch(timestamp))
+        FROM salary_history
+    ''')
+    conn.execute('DROP TABLE salary_history')
+    conn.execute('ALTER TABLE salary_history_new RENAME TO salary_history')
+    conn.execute('CREATE INDEX idx_history_user_ts ON salary_history (user_id, timestamp)')
+    conn.execute('CREATE INDEX idx_history_user_month ON salary_history (user_id, month)')
+
+
+def migration_monthly_totals(conn):
+    # Materialized per-user monthly aggregate, kept in sync by every ledger write
+    conn.execute('''
+        CREATE TABLE monthly_totals (
+            user_id INTEGER NOT NULL,
+            month INTEGER NOT NULL,  -- YYYYMM
+            total REAL NOT NULL DEFAULT 0,
+            adds REAL NOT NULL DEFAULT 0,  -- sum of positive amounts
+            minuses REAL NOT NULL DEFAULT 0,  -- sum of negative amounts, stored positive
+            last_update INTEGER,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX idx_monthly_totals_leaderboard ON monthly_totals (month, total DESC)')
+    _rebuild_monthly_totals(conn)
+
+
+def migration_outbox(conn):
+    # DMs waiting to be delivered; written in the same transaction as the ledger change they announce
+    conn.execute('''
+        CREATE TABLE outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending / failed, delivered rows are deleted
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt INTEGER NOT NULL,  -- epoch seconds
+            created INTEGER NOT NULL,
+            error TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_outbox_due ON outbox (next_attempt) WHERE status = 'pending'")
+
+
+def migration_compensating_entries(conn):
+    # Undo/redo append rows that point at the row they reverse instead of deleting history
+    conn.execute('ALTER TABLE salary_history ADD COLUMN reverses INTEGER REFERENCES salary_history(id)')
+    conn.execute('CREATE INDEX idx_history_user_id ON salary_history (user_id, id DESC)')
+    conn.execute('CREATE INDEX idx_history_executor_id ON salary_history (executor, id DESC)')
+    conn.execute('CREATE INDEX idx_history_reverses ON salary_history (reverses) WHERE reverses IS NOT NULL')
+
+
+def migration_archive_indexes(conn):
+    # Find archivable rows without scanning the hot table, and each user's opening-balance row directly
+    conn.execute("CREATE INDEX idx_history_archivable ON salary_history (month, user_id) WHERE command != 'opening'")
+    conn.execute("CREATE INDEX idx_history_opening ON salary_history (user_id) WHERE command = 'opening'")
+
+
+
+def migration_guild_config(conn):
+    # Per-guild settings overriding the defaults in code, values are JSON
+    conn.execute('''
+        CREATE TABLE config (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+def migration_undo_buckets(conn):
+    # Undo/redo rows used to be counted in adds/minuses by their own sign instead of the operation's bucket
+    _rebuild_monthly_totals(conn)
+
+
+def migration_undo_index(conn):
+    # Redo walks the undo rows newer than the last regular operation, without the other rows in that range
+    conn.execute("CREATE INDEX idx_history_undo ON salary_history (id) WHERE command = 'undo'")
+
+
+def migration_undo_origin(conn):
+    # Undo/redo rows record the regular operation they go back to, so executor-scoped undo and redo both
+    # attribute them to whoever ran that operation, however many undo/redo rounds lie in between
+    conn.execute('ALTER TABLE salary_history ADD COLUMN origin INTEGER')
+    origins = {}
+    for entry_id, reversed_id in conn.execute(
+            "SELECT id, reverses FROM salary_history WHERE command IN ('undo', 'redo') AND reverses IS NOT NULL ORDER BY id"):
+        # A row always reverses an older one, so its origin is already known unless it reverses a regular operation
+        origins[entry_id] = origins.get(reversed_id, reversed_id)
+    conn.executemany('UPDATE salary_history SET origin = ? WHERE id = ?', [(origin, entry_id) for entry_id, origin in origins.items()])
+    conn.execute("CREATE INDEX idx_history_redo ON salary_history (id) WHERE command = 'redo'")
+
+
+MIGRATIONS = [
+    migration_create_tables,
+    migration_typed_history,
+    migration_monthly_totals,
+    migration_outbox,
+    migration_compensating_entries,
+    migration_archive_indexes,
+    migration_guild_config,
+    migration_undo_buckets,
+    migration_undo_index,
+    migration_undo_origin,
+]
+
+
+def create_archive_schema(conn):
+    # The archive lives in its own file, so it is (re)created on every start rather than versioned
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.salary_history (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            command TEXT NOT NULL,
+            executor INTEGER,
+            current_salary REAL,
+            month INTEGER NOT NULL,
+            reverses INTEGER,
+            archived INTEGER NOT NULL,  -- epoch seconds
+            reason TEXT NOT NULL  -- 'compaction' or 'reset'
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_user_month ON salary_history (user_id, month)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_month ON salary_history (month, user_id)')
+
+
+def _run_migration(conn, version, step):
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+        return False
+    step(conn)
+    conn.execute(f'PRAGMA user_version = {version}')
+    return True
+
+
+async def migrate(db):
+    # The archive schema comes first, rebuilding the monthly totals reads from it
+    await db.write(create_archive_schema)
+    for version, step in enumerate(MIGRATIONS, 1):
+        if await db.write(_run_migration, version, step):
+            log.info('Database %s migrated to version %d (%s)', db.path, version, step.__name__)
+
+
+def _rebuild_monthly_totals(conn):
+    conn.execute('DELETE FROM monthly_totals')
+    conn.execute('''
+        INSERT INTO monthly_totals (user_id, month, total, adds, minuses, last_update)
+        SELECT user_id, month, SUM(amount),
+               SUM(CASE WHEN bucket > 0 THEN amount ELSE 0 END),
+               SUM(CASE WHEN bucket < 0 THEN -amount ELSE 0 END),
+               MAX(timestamp)
+        FROM (
+            SELECT user_id, month, amount, timestamp, CASE WHEN command = 'undo' THEN -amount ELSE amount END AS bucket
+            FROM salary_history WHERE command != 'opening'
+            UNION ALL
+            SELECT user_id, month, amount, timestamp, CASE WHEN command = 'undo' THEN -amount ELSE amount END AS bucket
+            FROM archive.salary_history WHERE reason = 'compaction'
+        )
+        GROUP BY user_id, month
+    ''')
+    return conn.execute('SELECT COUNT(*) FROM monthly_totals').fetchone()[0]
+
+
+def _bucket_sign(amount, command):
+    # Undo and redo stay in the adds/minuses bucket of the operation they reverse: an undo's amount is
+    # exactly the negation of the row it reverses, a redo's amount that of the operation it restores.
+    # So "+5, undo, redo" counts as +5 / -0 like a plain +5, without looking up the reversed row.
+    return -amount if command == 'undo' else amount
+
+
+def _update_monthly_totals(conn, entries, now):
+    # entries: (user_id, month, amount, command) of new ledger rows
+    deltas = {}
+    for user_id, month, amount, command in entries:
+        delta = deltas.setdefault((user_id, month), [0.0, 0.0, 0.0])
+        delta[0] += amount
+        if _bucket_sign(amount, command) > 0:
+            delta[1] += amount
+        else:
+            delta[2] -= amount
+    conn.executemany('''
+        INSERT INTO monthly_totals (user_id, month, total, adds, minuses, last_update)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, month) DO UPDATE SET
+            total = total + excluded.total,
+            adds = adds + excluded.adds,
+            minuses = minuses + excluded.minuses,
+            last_update = excluded.last_update
+    ''', [(user_id, month, total, adds, minuses, now) for (user_id, month), (total, adds, minuses) in deltas.items()])
+
+
+def _apply_adjustments(conn, store, ops, reverses=None):
+    # ops: list of (user_id, amount, command, executor_id, target_month, notify), applied in order.
+    # notify is an optional DM template, "{balance}" is replaced by the balance after the op.
+    # reverses: for undo/redo, (id of the history row each op compensates, id of the operation it goes back to).
+    # Returns the balance after each op.
+    now = int(time.time())
+    deltas = {}
+    for op in ops:
+        if not math.isfinite(op[1]):
+            # SQLite stores NaN as NULL, and an infinite balance can never be corrected
+            raise ValueError(f'Invalid amount {op[1]!r} for user {op[0]}')
+        deltas[op[0]] = deltas.get(op[0], 0.0) + op[1]
+
+    # One UPSERT per user in the batch, RETURNING gives the new balance without another SELECT
+    balances = {}
+    for user_id, delta in deltas.items():
+        # float(): RETURNING can hand back the integer value before REAL affinity is applied
+        balances[user_id] = final = float(conn.execute('''
+            INSERT INTO user_points (user_id, points) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET points = points + excluded.points
+            RETURNING points
+        ''', (user_id, delta)).fetchone()[0])
+        store.db.after_commit(lambda user_id=user_id, final=final: store.balance_cache.set(user_id, final))
+
+    # Walk the batch backwards from the final balances to get the balance after each op
+    results = []
+    for op in reversed(ops):
+        results.append(balances[op[0]])
+        balances[op[0]] -= op[1]
+    results.reverse()
+    history_rows = [
+        (user_id, now, amount, command, executor_id, balance, target_month, reversed_id, origin)
+        for (user_id, amount, command, executor_id, target_month, _), balance, (reversed_id, origin)
+        in zip(ops, results, reverses or [(None, None)] * len(ops))
+    ]
+
+    # Insert salary changes into the salary history
+    conn.executemany('''
+        INSERT INTO salary_history (user_id, timestamp, amount, command, executor, current_salary, month, reverses, origin)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', history_rows)
+    _update_monthly_totals(conn, [(op[0], op[4], op[1], op[2]) for op in ops], now)
+    _enqueue_dms(conn, store, [(op[0], op[5].format(balance=balance)) for op, balance in zip(ops, results) if op[5]], now)
+    return results
+
+
+# Group commit for ledger writes
+# Adjustments that arrive within max_delay of each other are applied in one
+# transaction (one fsync) instead of one commit per command. Each caller is
+# resumed only once its batch has been committed.
+WRITE_MAX_BATCH = int(os.environ.get('BOT_WRITE_MAX_BATCH', 100))
+WRITE_MAX_DELAY = float(os.environ.get('BOT_WRITE_MAX_DELAY', 0.01))
+
+
+class WriteQueue:
+    def __init__(self, store, max_batch=WRITE_MAX_BATCH, max_delay=WRITE_MAX_DELAY):
+        self.store = store
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        # Each entry is (ops, future); the ops of one entry always go into the same transaction
+        self._pending = []
+        self._pending_ops = 0
+        self._wakeup = None
+        self._full = None
+        self._task = None
+        self._closing = False
+        # Counters
+        self.batches = 0
+        self.ops = 0
+        self.largest_batch = 0
+        self.last_batch_size = 0
+        self.commit_time = 0.0
+        self.max_commit_time = 0.0
+
+    def _start(self):
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, op):
+        return (await self.submit_many([op]))[0]
+
+    async def submit_many(self, ops):
+        # All of ops are committed atomically, even if there are more than max_batch of them
+        for op in ops:
+            if not math.isfinite(op[1]):
+                raise ValueError(f'Invalid amount {op[1]!r} for user {op[0]}')
+        if self._task is None:
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((ops, future))
+        self._pending_ops += len(ops)
+        self._wakeup.set()
+        if self._pending_ops >= self.max_batch:
+            self._full.set()
+        return await future
+
+    def _take_batch(self):
+        count = 0
+        taken = 0
+        for ops, _ in self._pending:
+            if taken and count + len(ops) > self.max_batch:
+                break
+            count += len(ops)
+            taken += 1
+        batch = self._pending[:taken]
+        del self._pending[:taken]
+        self._pending_ops -= count
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if self._closing and not self._pending:
+                return
+            # Give concurrent callers a short window to join this batch
+            if not self._closing and self._pending_ops < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self._take_batch()
+            if self._pending_ops < self.max_batch:
+                self._full.clear()
+            if not self._pending:
+                self._wakeup.clear()
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        ops = [op for unit, _ in batch for op in unit]
+        started = time.perf_counter()
+        try:
+            results = await self.store.db.write(_apply_adjustments, self.store, ops)
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            # One bad entry must not fail everyone else's writes: retry each entry on its own
+            for unit in batch:
+                await self._commit([unit])
+            return
+        elapsed = time.perf_counter() - started
+        offset = 0
+        for unit, future in batch:
+            if not future.done():
+                future.set_result(results[offset:offset + len(unit)])
+            offset += len(unit)
+
+        self.batches += 1
+        self.ops += len(ops)
+        self.last_batch_size = len(ops)
+        self.largest_batch = max(self.largest_batch, len(ops))
+        self.commit_time += elapsed
+        self.max_commit_time = max(self.max_commit_time, elapsed)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'ops': self.ops,
+            'avg_batch_size': self.ops / self.batches if self.batches else 0.0,
+            'largest_batch': self.largest_batch,
+            'last_batch_size': self.last_batch_size,
+            'avg_commit_ms': self.commit_time / self.batches * 1000 if self.batches else 0.0,
+            'max_commit_ms': self.max_commit_time * 1000,
+        }
+
+    async def close(self):
+        # Flush whatever is still queued, then stop the flusher
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        self._closing = False
+
+
+
+# DM outbox
+# Commands never wait on Discord for DMs: the message is stored in the outbox table in the
+# same transaction as the ledger change and delivered later by a background dispatcher.
+DM_CONCURRENCY = 5
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_BATCH = 100
+
+
+def _enqueue_dms(conn, store, messages, now):
+    # messages: list of (user_id, text)
+    if not messages:
+        return
+    conn.executemany(
+        'INSERT INTO outbox (user_id, message, next_attempt, created) VALUES (?, ?, ?, ?)',
+        [(user_id, text, now, now) for user_id, text in messages])
+    store.db.after_commit(store.outbox.notify)
+
+
+def _due_dms(conn, now, limit):
+    return conn.execute(
+        "SELECT id, user_id, message, attempts FROM outbox WHERE status = 'pending' AND next_attempt <= ? ORDER BY id LIMIT ?",
+        (now, limit)).fetchall()
+
+
+def _next_dm_due(conn):
+    return conn.execute("SELECT MIN(next_attempt) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+
+def _settle_dms(conn, delivered, retry, failed):
+    # delivered: ids; retry: (next_attempt, ids); failed: (error, ids)
+    conn.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in delivered])
+    conn.executemany(
+        'UPDATE outbox SET attempts = attempts + 1, next_attempt = ?, error = ? WHERE id = ?',
+        [(next_attempt, error, i) for next_attempt, error, ids in retry for i in ids])
+    conn.executemany(
+        "UPDATE outbox SET status = 'failed', attempts = attempts + 1, error = ? WHERE id = ?",
+        [(error, i) for error, ids in failed for i in ids])
+
+
+def _split_message(text, limit=2000):
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        cut = cut if cut > 0 else limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    chunks.append(text)
+    return chunks
+
+
+class Outbox:
+    def __init__(self, db, workers=DM_CONCURRENCY, max_attempts=OUTBOX_MAX_ATTEMPTS):
+        self.db = db
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def start(self, client):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run(client))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def notify(self):
+        # Called on the writer thread after a commit that queued DMs
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self, client):
+        await client.wait_until_ready()
+        semaphore = asyncio.Semaphore(self.workers)
+        backoff = 1
+        while True:
+            try:
+                await self._dispatch(client, semaphore)
+                backoff = 1
+            except Exception:
+                # The dispatcher must outlive a failed query or an unexpected error, or no DM goes out until a restart
+                self.errors += 1
+                log.exception('Outbox dispatch failed')
+                await asyncio.sleep(backoff)
+                backoff = min(300, backoff * 2)
+
+    async def _dispatch(self, client, semaphore):
+        # Delivers one batch of due DMs, or waits until some are due
+        self._wakeup.clear()
+        now = int(time.time())
+        due = await self.db.read(_due_dms, now, OUTBOX_BATCH)
+        if not due:
+            next_due = await self.db.read(_next_dm_due)
+            timeout = 60 if next_due is None else min(60, max(1, next_due - now))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return
+
+        # Coalesce everything pending for the same user into one DM
+        per_user = {}
+        for entry_id, user_id, message, attempts in due:
+            ids, lines, most_attempts = per_user.get(user_id, ([], [], 0))
+            ids.append(entry_id)
+            lines.append(message)
+            per_user[user_id] = (ids, lines, max(most_attempts, attempts))
+        self.coalesced += len(due) - len(per_user)
+
+        results = await asyncio.gather(*(
+            self._deliver(client, semaphore, user_id, '\n'.join(lines))
+            for user_id, (_, lines, _) in per_user.items()
+        ))
+        delivered, retry, failed = [], [], []
+        for (user_id, (ids, _, attempts)), (ok, permanent, error) in zip(per_user.items(), results):
+            if ok:
+                delivered.extend(ids)
+            elif permanent or attempts + 1 >= self.max_attempts:
+                failed.append((error, ids))
+            else:
+                # Exponential backoff: 5s, 10s, 20s, ... capped at an hour
+                retry.append((now + min(3600, 5 * 2 ** attempts), error, ids))
+        await self.db.write(_settle_dms, delivered, retry, failed)
+        self.delivered += len(delivered)
+        self.retried += sum(len(ids) for _, _, ids in retry)
+        self.failed += sum(len(ids) for _, ids in failed)
+
+    async def _deliver(self, client, semaphore, user_id, text):
+        # Returns (delivered, permanent failure, error)
+        async with semaphore:
+            try:
+                user = client.get_user(user_id) or await client.fetch_user(user_id)
+                for chunk in _split_message(text):
+                    await user.send(chunk)
+                return True, False, None
+            except (discord.Forbidden, discord.NotFound) as e:
+                # DMs closed or the user is gone, retrying will not help
+                return False, True, str(e)
+            except (discord.HTTPException, OSError, asyncio.TimeoutError) as e:
+                return False, False, str(e)
+
+    def stats(self):
+        return {
+            'delivered': self.delivered,
+            'retried': self.retried,
+            'failed': self.failed,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+        }
+
+
+
+def _reset_points(conn, store, user_id, notify, archive):
+    conn.execute('DELETE FROM user_points WHERE user_id = ?', (user_id,))
+    store.db.after_commit(lambda: store.balance_cache.discard(user_id))
+    if archive:
+        # Keep the history in the archive instead of destroying it; opening rows only summarize archived rows
+        conn.execute(f'''
+            INSERT OR IGNORE INTO archive.salary_history ({ARCHIVE_COLUMNS}, archived, reason)
+            SELECT {ARCHIVE_COLUMNS}, ?, 'reset' FROM salary_history WHERE user_id = ? AND command != 'opening'
+        ''', (int(time.time()), user_id))
+        conn.execute("UPDATE archive.salary_history SET reason = 'reset' WHERE user_id = ?", (user_id,))
+    else:
+        conn.execute('DELETE FROM archive.salary_history WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM salary_history WHERE user_id = ?', (user_id,))
+    conn.execute('DELETE FROM monthly_totals WHERE user_id = ?', (user_id,))
+    if notify:
+        _enqueue_dms(conn, store, [(user_id, notify)], int(time.time()))
+
+
+# Undo/redo
+# The ledger is append-only: undo appends an 'undo' row with the opposite amount that
+# references the row it reverses, and redo appends a 'redo' row reversing that undo.
+# Both also point at their origin, the regular operation they go back to, and are
+# attributed to its executor: "!undo_by @A" and "!redo_by @A" act on A's operations
+# whoever ran the previous undo or redo.
+# A row is still in effect while nothing references it, which the partial index on
+# reverses answers in O(log n); undo candidates are walked newest-first on (user_id, id DESC)
+# or (executor, id DESC) and the redo rows, redo candidates on the partial index of undo rows.
+NOT_UNDOABLE = ('undo', 'opening')
+NOT_REGULAR = ('undo', 'redo', 'opening')
+
+
+def _undo_targets(conn, column, key, limit):
+    if column == 'user_id':
+        return conn.execute(f'''
+            SELECT h.id, h.user_id, h.amount, h.month, COALESCE(h.origin, h.id) FROM salary_history h
+            WHERE h.user_id = ? AND h.command NOT IN {NOT_UNDOABLE}
+              AND NOT EXISTS (SELECT 1 FROM salary_history r WHERE r.reverses = h.id)
+            ORDER BY h.id DESC LIMIT ?
+        ''', (key, limit)).fetchall()
+    # The executor's own operations merged with the redos of them, whoever ran the redo
+    return conn.execute(f'''
+        SELECT h.id, h.user_id, h.amount, h.month, h.id FROM salary_history h
+        WHERE h.{column} = ? AND h.command NOT IN {NOT_REGULAR}
+          AND NOT EXISTS (SELECT 1 FROM salary_history r WHERE r.reverses = h.id)
+        UNION ALL
+        SELECT h.id, h.user_id, h.amount, h.month, h.origin FROM salary_history h
+        CROSS JOIN salary_history o ON o.id = h.origin
+        WHERE h.command = 'redo' AND o.{column} = ?
+          AND NOT EXISTS (SELECT 1 FROM salary_history r WHERE r.reverses = h.id)
+        ORDER BY 1 DESC LIMIT ?
+    ''', (key, key, limit)).fetchall()
+
+
+def _redo_targets(conn, column, key, limit):
+    # Only undos newer than the last regular operation can be redone, a new operation clears the redo stack.
+    # Both scans walk undo rows newest-first above that bound and stop at the limit, never the whole
+    # history of the user or executor.
+    row = conn.execute(f'''
+        SELECT id FROM salary_history WHERE {column} = ? AND command NOT IN {NOT_REGULAR} ORDER BY id DESC LIMIT 1
+    ''', (key,)).fetchone()
+    last_regular = row[0] if row else 0
+    if column == 'user_id':
+        # An undo row has the user of the row it reverses
+        return conn.execute('''
+            SELECT h.id, h.user_id, h.amount, h.month, h.origin FROM salary_history h
+            WHERE h.user_id = ? AND h.command = 'undo' AND h.id > ?
+              AND NOT EXISTS (SELECT 1 FROM salary_history r WHERE r.reverses = h.id)
+            ORDER BY h.id DESC LIMIT ?
+        ''', (key, last_regular, limit)).fetchall()
+    return conn.execute(f'''
+        SELECT h.id, h.user_id, h.amount, h.month, h.origin FROM salary_history h
+        CROSS JOIN salary_history o ON o.id = h.origin  -- CROSS JOIN keeps h as the outer loop
+        WHERE h.command = 'undo' AND h.id > ? AND o.{column} = ?
+          AND NOT EXISTS (SELECT 1 FROM salary_history r WHERE r.reverses = h.id)
+        ORDER BY h.id DESC LIMIT ?
+    ''', (last_regular, key, limit)).fetchall()
+
+
+def _compensate(conn, store, column, key, limit, actor_id, redo):
+    # column: 'user_id' to undo/redo a user's operations, 'executor' for the operations an admin performed
+    targets = (_redo_targets if redo else _undo_targets)(conn, column, key, limit)
+    if not targets:
+        return []
+    command = 'redo' if redo else 'undo'
+    ops = [(user_id, -amount, command, actor_id, month, None) for _, user_id, amount, month, _ in targets]
+    balances = _apply_adjustments(conn, store, ops, [(entry_id, origin) for entry_id, *_, origin in targets])
+    return [(user_id, -amount, month, balance) for (_, user_id, amount, month, _), balance in zip(targets, balances)]
+
+
+def _history_page(conn, user_id, before, month, command, limit, archived=False):
+    # Keyset pagination: "before" is the (timestamp, id) of the last row already shown,
+    # so each page is a single index range scan no matter how deep into the history it is.
+    sql = 'SELECT id, timestamp, amount, command, executor, current_salary, month FROM salary_history WHERE user_id = ?'
+    params = [user_id]
+    if archived:
+        # Read-through for an archived month: the month's rows may be split between the hot table and the
+        # archive while compaction is running, UNION also drops a row copied to both by an interrupted run
+        sql = '''
+            SELECT id, timestamp, amount, command, executor, current_salary, month FROM (
+                SELECT id, timestamp, amount, command, executor, current_salary, month FROM salary_history
+                WHERE user_id = ? AND month = ? AND command != 'opening'
+                UNION
+                SELECT id, timestamp, amount, command, executor, current_salary, month FROM archive.salary_history
+                WHERE user_id = ? AND month = ? AND reason = 'compaction'
+            ) WHERE 1
+        '''
+        params = [user_id, month, user_id, month]
+    elif month is not None:
+        sql += ' AND month = ?'
+        params.append(month)
+    if command is not None:
+        sql += ' AND command = ?'
+        params.append(command)
+    if before is not None:
+        sql += ' AND (timestamp, id) < (?, ?)'
+        params.extend(before)
+    sql += ' ORDER BY timestamp DESC, id DESC LIMIT ?'
+    # One extra row tells us whether there is a next page
+    params.append(limit + 1)
+    return conn.execute(sql, params).fetchall()
+
+
+# Archival
+# Rows of months older than ARCHIVE_AFTER_MONTHS are moved, a few hundred rows per transaction, into
+# the attached archive file once they were also written before that cutoff: a back-dated entry stays
+# in the hot table, where undo can still reach it, until it is old in ledger time too. Each user keeps a single 'opening' row in the hot table that
+# carries the net amount of everything archived, so balances and recent history stay intact
+# while the hot table only holds recent months.
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('BOT_ARCHIVE_AFTER_MONTHS', 3))
+ARCHIVE_CHUNK = 500
+ARCHIVE_INTERVAL = 3600
+ARCHIVE_COLUMNS = 'id, user_id, timestamp, amount, command, executor, current_salary, month, reverses'
+
+
+def archive_cutoff(now=None):
+    # First month that stays in the hot table
+    now = now or datetime.now()
+    months = now.year * 12 + now.month - 1 - ARCHIVE_AFTER_MONTHS
+    return (months // 12) * 100 + months % 12 + 1
+
+
+def _archive_chunk(conn, cutoff, limit):
+    # Moves up to limit closed rows of one user, returns how many were moved
+    written_before = int(datetime(cutoff // 100, cutoff % 100, 1).timestamp())
+    row = conn.execute(
+        "SELECT user_id FROM salary_history WHERE month < ? AND timestamp < ? AND command != 'opening' LIMIT 1",
+        (cutoff, written_before)).fetchone()
+    if row is None:
+        return 0
+    user_id = row[0]
+    rows = conn.execute('''
+        SELECT id, timestamp, amount, current_salary, month FROM salary_history
+        WHERE user_id = ? AND month < ? AND timestamp < ? AND command != 'opening'
+        ORDER BY id LIMIT ?
+    ''', (user_id, cutoff, written_before, limit)).fetchall()
+    ids = [(entry_id,) for entry_id, *_ in rows]
+    now = int(time.time())
+
+    # INSERT OR IGNORE: if a previous run copied these rows but did not get to delete them, copying again is harmless
+    conn.executemany(f'''
+        INSERT OR IGNORE INTO archive.salary_history ({ARCHIVE_COLUMNS}, archived, reason)
+        SELECT {ARCHIVE_COLUMNS}, {now}, 'compaction' FROM salary_history WHERE id = ?
+    ''', ids)
+    conn.executemany('DELETE FROM salary_history WHERE id = ?', ids)
+
+    amount = sum(r[2] for r in rows)
+    last_timestamp = max(r[1] for r in rows)
+    last_month = max(r[4] for r in rows)
+    opening = conn.execute(
+        "SELECT id, timestamp, month FROM salary_history WHERE user_id = ? AND command = 'opening'", (user_id,)).fetchone()
+    if opening is None:
+        conn.execute('''
+            INSERT INTO salary_history (user_id, timestamp, amount, command, executor, current_salary, month)
+            VALUES (?, ?, ?, 'opening', NULL, ?, ?)
+        ''', (user_id, last_timestamp, amount, rows[-1][3], last_month))
+    else:
+        conn.execute('''
+            UPDATE salary_history SET amount = amount + ?, timestamp = ?, current_salary = ?, month = ? WHERE id = ?
+        ''', (amount, max(last_timestamp, opening[1]), rows[-1][3], max(last_month, opening[2]), opening[0]))
+    return len(rows)
+
+
+class Archiver:
+    def __init__(self, db, chunk=ARCHIVE_CHUNK, interval=ARCHIVE_INTERVAL):
+        self.db = db
+        self.chunk = chunk
+        self.interval = interval
+        self._task = None
+        self.archived = 0
+        self.runs = 0
+
+    async def compact(self, pause=0.05):
+        # Small transactions with a pause in between, so commands never wait long for the write lock
+        cutoff = archive_cutoff()
+        moved = 0
+        while True:
+            count = await self.db.write(_archive_chunk, cutoff, self.chunk)
+            if not count:
+                break
+            moved += count
+            self.archived += count
+            await asyncio.sleep(pause)
+        self.runs += 1
+        return moved
+
+    async def _run(self):
+        while True:
+            try:
+                await self.compact()
+            except sqlite3.Error:
+                log.exception('Archive compaction failed')
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {'archived': self.archived, 'runs': self.runs}
+
+
+# Online backups
+# A backup copies the database and its archive with SQLite's online backup API, from a
+# dedicated connection that holds one read transaction for the whole copy: both files come
+# from the same point in time, and with WAL the writer keeps committing meanwhile. The copy
+# runs on a worker thread a few pages per step with a short pause between steps, so it never
+# holds the disk for long. Backups are plain rollback-journal files named
+# <YYYYmmdd-HHMMSS>-<kind>.db (+ .archive.db); the newest BACKUP_KEEP of each kind are kept.
+BACKUP_INTERVAL = int(os.environ.get('BOT_BACKUP_INTERVAL', 6 * 3600))  # seconds, 0 disables scheduled backups
+BACKUP_KEEP = int(os.environ.get('BOT_BACKUP_KEEP', 7))
+BACKUP_PAGES = 256
+BACKUP_PAUSE = 0.005
+BACKUP_NAME = re.compile(r'(\d{8}-\d{6}(?:-\d+)?)-(\w+)')
+
+
+def _archive_file(path):
+    # Same naming as Database.archive_path
+    return os.path.splitext(path)[0] + '.archive.db'
+
+
+def _backup_copy(db, target, started):
+    # started() is called once the snapshot is fixed, before any page is copied
+    conn = sqlite3.connect(db.path, isolation_level=None, check_same_thread=False)
+    try:
+        conn.execute('ATTACH DATABASE ? AS archive', (db.archive_path,))
+        conn.execute('BEGIN')
+        conn.execute('SELECT COUNT(*) FROM main.sqlite_master').fetchone()
+        conn.execute('SELECT COUNT(*) FROM archive.sqlite_master').fetchone()
+        started()
+        for name, path in (('main', target), ('archive', _archive_file(target))):
+            if os.path.exists(path + '.part'):
+                os.remove(path + '.part')
+            dest = sqlite3.connect(path + '.part')
+            try:
+                conn.backup(dest, pages=BACKUP_PAGES, progress=lambda *_: time.sleep(BACKUP_PAUSE), name=name)
+                # A backup is a single self-contained file
+                dest.execute('PRAGMA journal_mode=DELETE')
+            finally:
+                dest.close()
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    for path in (target, _archive_file(target)):
+        os.replace(path + '.part', path)
+    return os.path.getsize(target) + os.path.getsize(_archive_file(target))
+
+
+def _open_backup(path):
+    conn = sqlite3.connect(pathlib.Path(path).resolve().as_uri() + '?mode=ro', uri=True)
+    conn.execute('ATTACH DATABASE ? AS archive', (pathlib.Path(_archive_file(path)).resolve().as_uri() + '?mode=ro',))
+    return conn
+
+
+def _verify_backup(path):
+    conn = _open_backup(path)
+    try:
+        problems = [row[0] for schema in ('main', 'archive')
+                    for row in conn.execute(f'PRAGMA {schema}.integrity_check')]
+        problems = [problem for problem in problems if problem != 'ok']
+        # Every balance must equal the sum of the user's ledger rows (opening rows included)
+        mismatched = conn.execute('''
+            SELECT COUNT(*) FROM user_points p
+            LEFT JOIN (SELECT user_id, SUM(amount) AS total FROM salary_history GROUP BY user_id) h USING (user_id)
+            WHERE ABS(p.points - COALESCE(h.total, 0)) > 0.000001
+        ''').fetchone()[0]
+        return {
+            'problems': problems,
+            'users': conn.execute('SELECT COUNT(*) FROM user_points').fetchone()[0],
+            'history': conn.execute('SELECT COUNT(*) FROM salary_history').fetchone()[0],
+            'archived': conn.execute('SELECT COUNT(*) FROM archive.salary_history').fetchone()[0],
+            'mismatched': mismatched,
+            'version': conn.execute('PRAGMA user_version').fetchone()[0],
+        }
+    finally:
+        conn.close()
+
+
+def _restore_copy(source, db):
+    # Runs with the store closed; the backup API writes the pages through SQLite's own locking
+    for src_path, dest_path in ((source, db.path), (_archive_file(source), db.archive_path)):
+        src = sqlite3.connect(pathlib.Path(src_path).resolve().as_uri() + '?mode=ro', uri=True)
+        dest = sqlite3.connect(dest_path)
+        try:
+            src.backup(dest, pages=BACKUP_PAGES)
+        finally:
+            src.close()
+            dest.close()
+
+
+class Backups:
+    def __init__(self, db, directory, interval=BACKUP_INTERVAL, keep=BACKUP_KEEP):
+        self.db = db
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self._task = None
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.last_seconds = 0.0
+        self.last_bytes = 0
+
+    def list(self, kind=None):
+        # Backup names, newest first
+        try:
+            files = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        names = []
+        for file in files:
+            match = BACKUP_NAME.fullmatch(file[:-3]) if file.endswith('.db') else None
+            if match and (kind is None or match.group(2) == kind):
+                names.append(file[:-3])
+        return sorted(names, reverse=True)
+
+    def path(self, name):
+        # Only names of existing backups are accepted, so a name can never point outside the directory
+        if name not in self.list():
+            return None
+        return os.path.join(self.directory, name + '.db')
+
+    def _new_path(self, kind):
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.directory, f'{stamp}-{kind}.db')
+        suffix = 1
+        while os.path.exists(path):
+            suffix += 1
+            path = os.path.join(self.directory, f'{stamp}-{suffix}-{kind}.db')
+        return path
+
+    def _start(self, kind):
+        loop = asyncio.get_running_loop()
+        started = loop.create_future()
+
+        def mark_started():
+            loop.call_soon_threadsafe(lambda: started.done() or started.set_result(None))
+
+        os.makedirs(self.directory, exist_ok=True)
+        done = loop.create_task(self._copy(self._new_path(kind), kind, started, mark_started))
+        return started, done
+
+    async def _copy(self, path, kind, started, mark_started):
+        self.running += 1
+        begin = time.perf_counter()
+        try:
+            size = await asyncio.get_running_loop().run_in_executor(None, _backup_copy, self.db, path, mark_started)
+        except Exception as e:
+            self.failed += 1
+            if not started.done():
+                started.set_exception(e)
+            log.exception('Backup %s failed', path)
+            raise
+        finally:
+            self.running -= 1
+        self.completed += 1
+        self.last_seconds = time.perf_counter() - begin
+        self.last_bytes = size
+        self._rotate(kind)
+        return os.path.basename(path)[:-3], size
+
+    async def run(self, kind):
+        # Waits for the whole copy, returns (name, size in bytes)
+        _, done = self._start(kind)
+        return await done
+
+    async def snapshot(self, kind):
+        # Returns as soon as the point in time is fixed; the copy finishes in the background,
+        # so a destructive command can go ahead right away without ending up in its own snapshot
+        started, done = self._start(kind)
+        done.add_done_callback(lambda task: task.cancelled() or task.exception())
+        await started
+        return done
+
+    def _rotate(self, kind):
+        for name in self.list(kind)[self.keep:]:
+            for path in (os.path.join(self.directory, name + '.db'), os.path.join(self.directory, name + '.archive.db')):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    async def _run(self):
+        while True:
+            # The first backup of a new database is also only taken after a full interval
+            latest = self.list('scheduled')
+            age = time.time() - os.path.getmtime(self.path(latest[0])) if latest else 0
+            await asyncio.sleep(max(0, self.interval - age))
+            try:
+                await self.run('scheduled')
+            except (sqlite3.Error, OSError):
+                # Already reported, try again later rather than in a tight loop
+                await asyncio.sleep(min(self.interval, 600))
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'last_seconds': self.last_seconds,
+            'last_bytes': self.last_bytes,
+        }
+
+
+# Per-guild storage
+# Each guild has its own database file (plus archive) with its own writer thread, write queue,
+# balance cache, outbox and archiver, so guilds never wait on each other's writes and write
+# throughput grows with the number of guilds. A store is opened the first time a command
+# needs it (resolving the prefix only reads the config, see get_config). The database from
+# before multi-guild support is kept as the store of the guild that owns it, see resolve_legacy_guild.
+DB_PATH = os.environ.get('BOT_DB_PATH', 'bot_data.db')
+DATA_DIR = os.environ.get('BOT_DATA_DIR', os.path.dirname(DB_PATH) or '.')
+LEGACY_GUILD_ID = int(os.environ['BOT_LEGACY_GUILD_ID']) if os.environ.get('BOT_LEGACY_GUILD_ID') else None
+BACKUP_DIR = os.environ.get('BOT_BACKUP_DIR', os.path.join(DATA_DIR, 'backups'))
+legacy_guild_id = LEGACY_GUILD_ID  # the guild that owns DB_PATH, final once _legacy_resolved is set
+_legacy_resolved = None  # asyncio.Event, created in setup_hook
+startup_error = None
+
+
+def _legacy_claim():
+    # The guild recorded in DB_PATH when a guild first opened it; read-only, so a missing file is never created
+    try:
+        conn = sqlite3.connect(pathlib.Path(DB_PATH).resolve().as_uri() + '?mode=ro', uri=True)
+        try:
+            row = conn.execute("SELECT value FROM config WHERE key = 'guild_id'").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.OperationalError:
+        return None
+    return json.loads(row[0]) if row else None
+
+
+def resolve_legacy_guild(guild_ids):
+    # Returns (guild that owns DB_PATH or None, error). Without BOT_LEGACY_GUILD_ID the file is
+    # adopted only when it is unambiguous: this process serves every shard and exactly one guild.
+    if not os.path.exists(DB_PATH):
+        return LEGACY_GUILD_ID, None
+    claimed = _legacy_claim()
+    if LEGACY_GUILD_ID is not None and claimed is not None and claimed != LEGACY_GUILD_ID:
+        return None, f'{DB_PATH} belongs to guild {claimed}, not to BOT_LEGACY_GUILD_ID={LEGACY_GUILD_ID}'
+    owner = LEGACY_GUILD_ID or claimed
+    if owner is None:
+        if guild_ids is None or len(guild_ids) != 1 or SHARD_IDS is not None:
+            return None, f'{DB_PATH} exists but no guild owns it yet, set BOT_LEGACY_GUILD_ID to the guild its data belongs to'
+        owner = guild_ids[0]
+    # Data written to a separate file for the same guild would otherwise be hidden or lost
+    separate = os.path.join(DATA_DIR, f'guild_{owner}.db')
+    if os.path.exists(separate):
+        return None, f'Guild {owner} has both {DB_PATH} and {separate}, merge or remove one of them before starting'
+    return owner, None
+
+
+def store_path(guild_id):
+    if guild_id == legacy_guild_id:
+        return DB_PATH
+    return os.path.join(DATA_DIR, f'guild_{guild_id}.db')
+
+
+class GuildStore:
+    def __init__(self, guild_id, path):
+        self.guild_id = guild_id
+        self.db = Database(path)
+        self.balance_cache = BalanceCache()
+        self.write_queue = WriteQueue(self)
+        self.outbox = Outbox(self.db)
+        self.archiver = Archiver(self.db)
+        self.backups = Backups(self.db, os.path.join(BACKUP_DIR, f'guild_{guild_id}'))
+        self.client = None
+
+    async def open(self, client):
+        self.client = client
+        await migrate(self.db)
+        values = await self.db.read(_load_config)
+        configs[self.guild_id] = GuildConfig(values)
+        if self.db.path == DB_PATH and 'guild_id' not in values:
+            # Claim the legacy database, so it is never adopted by another guild later
+            await self.db.write(_save_config, 'guild_id', self.guild_id)
+        for user_id, points in await self.db.read(_warm_balances, self.balance_cache.capacity):
+            self.balance_cache.set(user_id, points)
+        self.outbox.start(client)
+        self.archiver.start()
+        self.backups.start()
+
+    async def close(self):
+        await self.write_queue.close()
+        await self.outbox.stop()
+        await self.archiver.stop()
+        await self.backups.stop()
+        await asyncio.get_running_loop().run_in_executor(None, self.db.close)
+
+    def stats(self):
+        return {
+            'write_queue': self.write_queue.stats(),
+            'balance_cache': self.balance_cache.stats(),
+            'outbox': self.outbox.stats(),
+            'archiver': self.archiver.stats(),
+            'backups': self.backups.stats(),
+        }
+
+
+stores = {}  # guild_id -> GuildStore
+_opening = {}  # guild_id -> task opening its store
+
+
+async def _open_store(guild_id, client):
+    # No store may open before it is known which guild owns the legacy database
+    if _legacy_resolved is not None:
+        await _legacy_resolved.wait()
+    store = GuildStore(guild_id, store_path(guild_id))
+    try:
+        await store.open(client)
+    except BaseException:
+        await store.close()
+        raise
+    stores[guild_id] = store
+    return store
+
 
-    # Insert salary change into the salary history
-    cursor.execute('''
-        INSERT INTO salary_history (user_id, timestamp, amount, command, executor, current_salary, month)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (user_id, current_month, amount, command, executor_id, cursor.execute('SELECT points FROM user_points WHERE user_id = ?', (user_id,)).fetchone()[0], target_month))
-    # ...
-    conn.commit()
+async def get_store(guild_id, client=None):
+    # Concurrent first uses share one opening task; client receives the outbox DMs, the bot by default
+    store = stores.get(guild_id)
+    if store is not None:
+        return store
+    task = _opening.get(guild_id)
+    if task is None:
+        task = _opening[guild_id] = asyncio.get_running_loop().create_task(_open_store(guild_id, client or bot))
+    try:
+        return await task
+    finally:
+        if _opening.get(guild_id) is task and task.done():
+            del _opening[guild_id]
 
 
+async def close_store(guild_id):
+    store = stores.pop(guild_id, None)
+    if store is not None:
+        await store.close()
+
+
+async def restore_store(guild_id, name):
+    # Replaces the guild's database with a backup; returns False if there is no such backup.
+    # Commands that arrive meanwhile wait in get_store until the restored store is open.
+    store = await get_store(guild_id)
+    source = store.backups.path(name)
+    if source is None:
+        return False
+    # The state being replaced is kept as a backup too
+    await store.backups.run('restore')
+
+    async def reopen():
+        await close_store(guild_id)
+        await asyncio.get_running_loop().run_in_executor(None, _restore_copy, source, store.db)
+        restored = await _open_store(guild_id, store.client)
+        # The backup has its own config table, which the store just loaded into configs
+        invalidate_role_index(guild_id)
+        return restored
+
+    task = _opening[guild_id] = asyncio.get_running_loop().create_task(reopen())
+    try:
+        await task
+    finally:
+        if _opening.get(guild_id) is task:
+            del _opening[guild_id]
+    return True
+
+
+# Function to add or subtract points and update history, returns the new balance.
+# notify is an optional DM for the user ("{balance}" is filled in), queued in the same transaction.
+async def update_points(guild_id, user_id, amount, command, executor_id, target_month, notify=None):
+    store = await get_store(guild_id)
+    return await store.write_queue.submit((user_id, amount, command, executor_id, target_month, notify))
+
+
+# Apply many adjustments in a single transaction, returns the balance after each one
+async def update_points_many(guild_id, ops):
+    store = await get_store(guild_id)
+    return await store.write_queue.submit_many(ops)
+
+
+async def reset_user(guild_id, user_id, notify=None, archive=False):
+    store = await get_store(guild_id)
+    # Point-in-time snapshot of the state just before the reset
+    await store.backups.snapshot('reset')
+    await store.db.write(_reset_points, store, user_id, notify, archive)
+
+
+# Undo (or redo) the last n operations of a user or of an executor; returns (user_id, amount, month, balance) per entry
+async def undo_operations(guild_id, column, key, n, actor_id, redo=False):
+    store = await get_store(guild_id)
+    return await store.db.write(_compensate, store, column, key, n, actor_id, redo)
+
+
+def _balance(conn, user_id):
+    row = conn.execute('SELECT points FROM user_points WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0.0
+
+
+def _warm_balances(conn, limit):
+    return conn.execute('SELECT user_id, points FROM user_points LIMIT ?', (limit,)).fetchall()
+
+
+def _monthly_breakdown(conn, user_id, limit):
+    return conn.execute(
+        'SELECT month, total, adds, minuses FROM monthly_totals WHERE user_id = ? ORDER BY month DESC LIMIT ?',
+        (user_id, limit)).fetchall()
+
+
+def _leaderboard(conn, month, limit):
+    return conn.execute(
+        'SELECT user_id, total FROM monthly_totals WHERE month = ? ORDER BY total DESC LIMIT ?',
+        (month, limit)).fetchall()
+
+
+async def get_balance(guild_id, user_id):
+    store = await get_store(guild_id)
+    balance = store.balance_cache.get(user_id)
+    if balance is None:
+        balance = await store.db.read(_balance, user_id)
+    return balance
+
+
+async def warm_balance_cache(guild_id):
+    store = await get_store(guild_id)
+    for user_id, points in await store.db.read(_warm_balances, store.balance_cache.capacity):
+        store.balance_cache.set(user_id, points)
+
+
+async def monthly_breakdown(guild_id, user_id, limit=12):
+    store = await get_store(guild_id)
+    return await store.db.read(_monthly_breakdown, user_id, limit)
+
+
+async def leaderboard(guild_id, month, limit=10):
+    store = await get_store(guild_id)
+    return await store.db.read(_leaderboard, month, limit)
+
+
+async def rebuild_monthly_totals(guild_id):
+    store = await get_store(guild_id)
+    return await store.db.write(_rebuild_monthly_totals)
+
+
+async def fetch_history_page(guild_id, user_id, before=None, month=None, command=None, limit=15):
+    # Months old enough to have been compacted are read from the archive as well
+    store = await get_store(guild_id)
+    archived = month is not None and month < archive_cutoff()
+    return await store.db.read(_history_page, user_id, before, month, command, limit, archived)
+
+
+# Export
+# A month is streamed row by row from SQLite cursors into a spooled temporary file, which
+# stays in memory while small and rolls over to disk, so memory is flat whatever the guild size.
+# The whole export runs on a reader thread and never touches the event loop.
+EXPORT_SPOOL_SIZE = 8 * 1024 * 1024
+EXPORT_SUMMARY_FIELDS = ('user_id', 'member', 'month', 'adds', 'minuses', 'total', 'balance')
+EXPORT_ENTRY_FIELDS = ('id', 'time', 'user_id', 'member', 'command', 'amount', 'current_salary', 'executor')
+
+
+def _month_summary(conn, month, name_of):
+    # Ordered by the leaderboard index, no sort needed
+    for user_id, adds, minuses, total, balance in conn.execute('''
+        SELECT t.user_id, t.adds, t.minuses, t.total, COALESCE(p.points, 0)
+        FROM monthly_totals t LEFT JOIN user_points p ON p.user_id = t.user_id
+        WHERE t.month = ? ORDER BY t.total DESC
+    ''', (month,)):
+        yield user_id, name_of(user_id), month, adds, minuses, total, balance
+
+
+def _month_entries(conn, month, name_of):
+    # Grouped by member: the (month, user_id) indexes return rows in (user_id, id) order, so
+    # SQLite merges the hot table and the archive instead of sorting the month
+    sql = '''
+        SELECT id, timestamp, user_id, command, amount, current_salary, executor FROM salary_history
+        WHERE month = ? AND command != 'opening'
+    '''
+    params = [month]
+    if month < archive_cutoff():
+        sql += '''
+            UNION
+            SELECT id, timestamp, user_id, command, amount, current_salary, executor FROM archive.salary_history
+            WHERE month = ? AND reason = 'compaction'
+        '''
+        params.append(month)
+    sql += ' ORDER BY user_id, id'
+    for entry_id, timestamp, user_id, command, amount, current_salary, executor in conn.execute(sql, params):
+        when = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        yield entry_id, when, user_id, name_of(user_id), command, amount, current_salary, executor
+
+
+def _write_rows(out, fmt, fields, rows):
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow(row)
+        return
+    # JSON array written one object at a time
+    out.write('[')
+    separator = '\n'
+    for row in rows:
+        out.write(separator)
+        json.dump(dict(zip(fields, row)), out, ensure_ascii=False)
+        separator = ',\n'
+    out.write('\n]\n')
+
+
+def _export_file(fmt, compress, fields, rows):
+    # Returns the spooled file rewound to the start, and its size in bytes
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    try:
+        raw = gzip.GzipFile(fileobj=spool, mode='wb') if compress else spool
+        # utf-8-sig so spreadsheet programs read Vietnamese names in the CSV correctly
+        out = io.TextIOWrapper(raw, encoding='utf-8-sig' if fmt == 'csv' else 'utf-8', newline='')
+        _write_rows(out, fmt, fields, rows)
+        out.flush()
+        out.detach()
+        if compress:
+            raw.close()
+        size = spool.tell()
+        spool.seek(0)
+        return spool, size
+    except BaseException:
+        spool.close()
+        raise
+
+
+def _export_month(conn, month, fmt, compress, name_of):
+    # One read transaction, so the summary and the entries come from the same snapshot
+    conn.execute('BEGIN')
+    try:
+        summary = _export_file(fmt, compress, EXPORT_SUMMARY_FIELDS, _month_summary(conn, month, name_of))
+        try:
+            entries = _export_file(fmt, compress, EXPORT_ENTRY_FIELDS, _month_entries(conn, month, name_of))
+        except BaseException:
+            summary[0].close()
+            raise
+    finally:
+        conn.execute('COMMIT')
+    return summary, entries
+
+
+async def export_month(guild_id, month, fmt='csv', compress=False, name_of=lambda user_id: ''):
+    store = await get_store(guild_id)
+    return await store.db.read(_export_month, month, fmt, compress, name_of)
+
+
+async def backup_now(guild_id, kind='manual'):
+    store = await get_store(guild_id)
+    return await store.backups.run(kind)
+
+
+async def list_backups(guild_id):
+    store = await get_store(guild_id)
+    return [(name, sum(os.path.getsize(path) for path in (store.backups.path(name), _archive_file(store.backups.path(name)))))
+            for name in store.backups.list()]
+
+
+async def verify_backup(guild_id, name):
+    # Returns the check results, or None if there is no such backup
+    store = await get_store(guild_id)
+    path = store.backups.path(name)
+    if path is None:
+        return None
+    return await asyncio.get_running_loop().run_in_executor(None, _verify_backup, path)
+
+
+@bot.event
+async def setup_hook():
+    # Guild stores are opened on first use, see get_store
+    global _legacy_resolved, legacy_guild_id
+    _legacy_resolved = asyncio.Event()
+    if LEGACY_GUILD_ID is not None or not os.path.exists(DB_PATH) or _legacy_claim() is not None:
+        # Known before connecting; otherwise decided in on_ready from the guild list
+        legacy_guild_id, error = resolve_legacy_guild(None)
+        if error:
+            raise RuntimeError(error)
+        _legacy_resolved.set()
+    telemetry.start()
+    if METRICS_PORT:
+        await asyncio.start_server(serve_metrics, '127.0.0.1', METRICS_PORT)
+
+
+@bot.event
+async def on_ready():
+    global legacy_guild_id, startup_error
+    if _legacy_resolved.is_set():
+        return
+    owner, error = resolve_legacy_guild([guild.id for guild in bot.guilds])
+    if error:
+        startup_error = error
+        await bot.close()
+        return
+    legacy_guild_id = owner
+    log.info('%s is the database of guild %s', DB_PATH, owner)
+    _legacy_resolved.set()
+
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+    charge_rate_limit(ctx)
+
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    telemetry.record_command(ctx.command.qualified_name, time.perf_counter() - ctx.started_at)
+
+
+@bot.event
+async def on_guild_remove(guild):
+    await close_store(guild.id)
+    configs.pop(guild.id, None)
+    invalidate_role_index(guild.id)
+
+
+def component_stats():
+    return {
+        'rate_limiter': rate_limiter.stats(),
+        'stores': {'open': len(stores)},
+    }
+
+
+# Prometheus text format, served on 127.0.0.1:BOT_METRICS_PORT when it is set
+def render_metrics():
+    lines = []
+
+    def summary(metric, help_text, table, label_names):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} summary")
+        for key, stats in table.items():
+            key = key if isinstance(key, tuple) else (key,)
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(label_names, key))
+            for q, value in zip((0.5, 0.95, 0.99), stats.quantiles(0.5, 0.95, 0.99)):
+                lines.append(f'{metric}{{{labels},quantile="{q}"}} {value}')
+            lines.append(f'{metric}_sum{{{labels}}} {stats.total}')
+            lines.append(f'{metric}_count{{{labels}}} {stats.count}')
+
+    def counter(metric, help_text, table):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for (kind, name), value in table.items():
+            lines.append(f'{metric}{{kind="{kind}",query="{name}"}} {value}')
+
+    summary('bot_command_seconds', 'Command latency', telemetry.commands, ('command',))
+    summary('bot_db_query_seconds', 'Time spent running a DB call', telemetry.queries, ('kind', 'query'))
+    summary('bot_db_wait_seconds', 'Time a DB call waited for a DB thread', telemetry.query_wait, ('kind', 'query'))
+    counter('bot_db_rows_returned_total', 'Rows returned by DB calls', telemetry.rows)
+    counter('bot_db_vm_steps_total', 'SQLite VM instructions executed (rows scanned proxy)', telemetry.vm_steps)
+    lines.append(f"bot_db_commits_total {telemetry.commits}")
+    lines.append(f"bot_db_rollbacks_total {telemetry.rollbacks}")
+    p50, p99 = telemetry.loop_lag.quantiles(0.5, 0.99)
+    lines.append(f'bot_event_loop_lag_seconds{{quantile="0.5"}} {p50}')
+    lines.append(f'bot_event_loop_lag_seconds{{quantile="0.99"}} {p99}')
+    lines.append(f"bot_event_loop_lag_seconds_max {telemetry.loop_lag.max}")
+    for component, values in component_stats().items():
+        for name, value in values.items():
+            if isinstance(value, (int, float)):
+                lines.append(f"bot_{component}_{name} {value}")
+    for guild_id, store in stores.items():
+        for component, values in store.stats().items():
+            for name, value in values.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f'bot_{component}_{name}{{guild="{guild_id}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = render_metrics().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
 
 
 # Define the role IDs for each command
+# These are the defaults, each guild can override them (and the prefix and rate limits) with !config
 role_ids = {
     'a': [1202583369708474368],  # Role Admin
     'm': [1202583369708474368],  # Role Ad
     'undo': [1202583369708474368],  # Role Ad
+    'redo': [1202583369708474368],  # Role Ad
     'reset': [1202589756647673856],  # Boss
-    'view': [1203246669630672906, 1202583369708474368]  # Role staff
+    'view': [1203246669630672906, 1202583369708474368],  # Role staff
+    'top': [1203246669630672906, 1202583369708474368],  # Role staff
+    'rebuild': [1202589756647673856],  # Boss
+    'bulk': [1202583369708474368],  # Role Admin
+    'stats': [1203246669630672906, 1202583369708474368],  # Role staff
+    'export': [1202589756647673856, 1202583369708474368],  # Boss, Role Admin
+    'backup': [1202589756647673856, 1202583369708474368],  # Boss, Role Admin
+    'restore': [1202589756647673856],  # Boss
 }
 
+# Rate limit for each command: (số lệnh, trong bao nhiêu giây)
+rate_limits = {
+    'a': (10, 10),
+    'm': (10, 10),
+    'undo': (5, 10),
+    'redo': (5, 10),
+    'reset': (2, 30),
+    'view': (3, 30),
+    'top': (3, 30),
+    'rebuild': (1, 60),
+    'bulk': (2, 60),
+    'stats': (3, 30),
+    'export': (2, 60),
+    'backup': (2, 60),
+    'restore': (1, 60),
+}
+
+
+class GuildConfig:
+    def __init__(self, values=None):
+        # values: raw rows of the guild's config table, only what differs from the defaults is stored
+        values = values or {}
+        self.prefix = json.loads(values['prefix']) if 'prefix' in values else DEFAULT_PREFIX
+        self.role_ids = {**role_ids, **json.loads(values.get('role_ids', '{}'))}
+        self.rate_limits = {**rate_limits, **{name: tuple(limit) for name, limit in json.loads(values.get('rate_limits', '{}')).items()}}
+
+
+DEFAULT_CONFIG = GuildConfig()
+
+
+def _load_config(conn):
+    return dict(conn.execute('SELECT key, value FROM config').fetchall())
+
+
+def _save_config(conn, key, value):
+    conn.execute(
+        'INSERT INTO config (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+        (key, json.dumps(value)))
+    return _load_config(conn)
+
+
+configs = {}  # guild_id -> GuildConfig, also kept for guilds whose store is not open
+
+
+def _read_config_file(path):
+    # Reads a guild's settings without opening its store; a guild without a database has none
+    if not os.path.exists(path):
+        return {}
+    conn = sqlite3.connect(path)
+    try:
+        return _load_config(conn)
+    except sqlite3.OperationalError:
+        # Database from before the config table, migrated when its store opens
+        return {}
+    finally:
+        conn.close()
+
+
+async def get_config(guild_id):
+    config = configs.get(guild_id)
+    if config is None:
+        if _legacy_resolved is not None:
+            await _legacy_resolved.wait()
+        values = await asyncio.get_running_loop().run_in_executor(None, _read_config_file, store_path(guild_id))
+        config = configs.setdefault(guild_id, GuildConfig(values))
+    return config
+
+
+def guild_config(guild):
+    # Checks are synchronous; the config is always cached by then because resolving the prefix read it
+    return configs.get(guild.id, DEFAULT_CONFIG) if guild else DEFAULT_CONFIG
+
+
+async def update_config(guild_id, key, value):
+    store = await get_store(guild_id)
+    config = configs[guild_id] = GuildConfig(await store.db.write(_save_config, key, value))
+    invalidate_role_index(guild_id)
+    return config
+
+
+# Precomputed permission index, so a role check is a set intersection instead of scanning guild roles
+_role_index = {}  # guild_id -> {command_name: frozenset of allowed role ids that exist in the guild}
+_member_roles = {}  # (guild_id, member_id) -> frozenset of the member's role ids
+
+
+def _allowed_roles(guild, command_name):
+    index = _role_index.get(guild.id)
+    if index is None:
+        present = frozenset(role.id for role in guild.roles)
+        index = _role_index[guild.id] = {name: present.intersection(ids) for name, ids in guild_config(guild).role_ids.items()}
+    return index.get(command_name, frozenset())
+
+
+def _member_role_ids(member):
+    key = (member.guild.id, member.id)
+    role_set = _member_roles.get(key)
+    if role_set is None:
+        role_set = _member_roles[key] = frozenset(role.id for role in member.roles)
+    return role_set
+
+
+def invalidate_role_index(guild_id):
+    _role_index.pop(guild_id, None)
+
+
+@bot.event
+async def on_guild_role_update(before, after):
+    invalidate_role_index(after.guild.id)
+
+
+@bot.event
+async def on_guild_role_delete(role):
+    invalidate_role_index(role.guild.id)
+    # Members who had the role keep a stale role set otherwise
+    for key in [key for key, role_set in _member_roles.items() if key[0] == role.guild.id and role.id in role_set]:
+        del _member_roles[key]
+
+
+@bot.event
+async def on_member_update(before, after):
+    _member_roles.pop((after.guild.id, after.id), None)
+
+
+@bot.event
+async def on_member_remove(member):
+    _member_roles.pop((member.guild.id, member.id), None)
+
+
 # Check if the user has the correct role for a specific command
 def has_correct_role(ctx, command_name):
-    allowed_roles = [discord.utils.get(ctx.guild.roles, id=role_id) for role_id in role_ids.get(command_name, [])]
-    return any(role in ctx.author.roles for role in allowed_roles)
+    if ctx.guild is None:
+        return False
+    return not _allowed_roles(ctx.guild, command_name).isdisjoint(_member_role_ids(ctx.author))
 
 # Check if the user has the required permissions
 def has_permissions(ctx, command_name):
@@ -89,52 +1970,228 @@ def has_permissions(ctx, command_name):
         return ctx.author.guild_permissions.manage_messages
     elif command_name == 'undo':
         return ctx.author.guild_permissions.manage_messages
+    elif command_name == 'redo':
+        return ctx.author.guild_permissions.manage_messages
+    elif command_name == 'bulk':
+        return ctx.author.guild_permissions.manage_messages
     elif command_name == 'view':
         return True  # No specific permissions required for view command
     return True
 
+# Token bucket per (guild, user, command)
+class TokenBucket:
+    __slots__ = ('tokens', 'updated', 'warned', 'per')
+
+    def __init__(self, tokens, now, per):
+        self.tokens = tokens
+        self.updated = now
+        self.warned = False
+        self.per = per
+
+
+class RateLimiter:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self.allowed = 0
+        self.throttled = 0
+        self.throttled_by_command = {}
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            oldest = next(iter(buckets.values()))
+            # A bucket idle for its whole period has refilled completely, so dropping it changes nothing.
+            # Limits are configurable per guild, so the period is the bucket's own, not a global TTL.
+            if len(buckets) <= self.max_entries and now - oldest.updated < oldest.per:
+                break
+            buckets.popitem(last=False)
+
+    def hit(self, key, calls, per):
+        # Returns 0 if the call is allowed, otherwise the seconds until a token is available
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(calls, now, per)
+            self._evict(now)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(calls, bucket.tokens + (now - bucket.updated) * calls / per)
+            bucket.updated = now
+            bucket.per = per
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            self.allowed += 1
+            return 0
+        self.throttled += 1
+        command_name = key[2]
+        self.throttled_by_command[command_name] = self.throttled_by_command.get(command_name, 0) + 1
+        return (1 - bucket.tokens) * per / calls
+
+    def should_warn(self, key):
+        # Warn once per throttled streak so the warnings cannot be used to spam the channel either
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.warned:
+            return False
+        bucket.warned = True
+        return True
+
+    def stats(self):
+        return {
+            'buckets': len(self._buckets),
+            'allowed': self.allowed,
+            'throttled': self.throttled,
+            'throttled_by_command': dict(self.throttled_by_command),
+        }
+
+
+rate_limiter = RateLimiter()
+
+
+class Spamming(commands.CheckFailure):
+    def __init__(self, key, retry_after):
+        super().__init__(f"Spamming {key[2]}, retry after {retry_after:.1f}s")
+        self.key = key
+        self.retry_after = retry_after
+
+
 # Check if the user is spamming commands
+# The check only notes which bucket the command uses. Checks also run when nothing is invoked
+# (a help command filtering what a member may use), so the token is taken in charge_rate_limit,
+# called from before_invoke once the command is really about to run.
 def is_spamming(ctx, command_name):
-    # Customize this function based on your spamming prevention requirements
-    return False  # Replace this with your spamming check logic
+    ctx.rate_limit = (ctx.command, command_name)
+    return False
+
+
+def charge_rate_limit(ctx):
+    command, command_name = getattr(ctx, 'rate_limit', (None, None))
+    if command is None or command is not ctx.command:
+        return
+    limit = guild_config(ctx.guild).rate_limits.get(command_name)
+    if limit is None:
+        return
+    key = (ctx.guild.id if ctx.guild else 0, ctx.author.id, command_name)
+    retry_after = rate_limiter.hit(key, *limit)
+    if retry_after:
+        # Raised rather than returning True so on_command_error can tell throttling apart from a missing role
+        raise Spamming(key, retry_after)
 
 # Send a warning message to the user
 async def send_warning(ctx, message):
     await ctx.send(f":warning: **{message}**")
 
+
+@bot.event
+async def on_command_error(ctx, error):
+    if isinstance(error, Spamming):
+        if rate_limiter.should_warn(error.key):
+            await send_warning(ctx, f"Bạn dùng lệnh quá nhanh, vui lòng thử lại sau {math.ceil(error.retry_after)} giây.")
+        return
+    await commands.Bot.on_command_error(bot, ctx, error)
+
+# Paginated salary history, only the page being shown is fetched and formatted
+HISTORY_PAGE_SIZE = 15
+
+
+class HistoryView(discord.ui.View):
+    def __init__(self, user, month=None, command=None, page_size=HISTORY_PAGE_SIZE):
+        super().__init__(timeout=300)
+        self.user = user
+        self.month = month
+        self.command = command
+        self.page_size = page_size
+        # Keyset cursor of each page visited so far; the last one is the current page
+        self.cursors = [None]
+        self.rows = []
+        self.balance = None
+        self.message = None
+
+    async def load(self):
+        if self.balance is None:
+            self.balance = await get_balance(self.user.guild.id, self.user.id)
+        rows = await fetch_history_page(self.user.guild.id, self.user.id, self.cursors[-1], self.month, self.command, self.page_size)
+        self.rows = rows[:self.page_size]
+        self.previous_page.disabled = len(self.cursors) == 1
+        self.next_page.disabled = len(rows) <= self.page_size
+
+    def render(self):
+        lines = [
+            f"{format_month(month)}: {command} {amount} K (Tổng lương: {current_salary} K)"
+            for _, _, amount, command, _, current_salary, month in self.rows
+        ]
+        embed = discord.Embed(title=f"Lịch sử lương của {self.user.display_name}", description='\n'.join(lines))
+        embed.add_field(name="Lương hiện tại", value=f"{self.balance} K")
+        filters = [format_month(self.month)] if self.month else []
+        if self.command:
+            filters.append(self.command)
+        embed.set_footer(text=' | '.join([f"Trang {len(self.cursors)}"] + filters))
+        return embed
+
+    async def show(self, interaction):
+        await self.load()
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(label='◀ Trước', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        self.cursors.pop()
+        await self.show(interaction)
+
+    @discord.ui.button(label='Sau ▶', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        last_id, last_timestamp = self.rows[-1][:2]
+        self.cursors.append((last_timestamp, last_id))
+        await self.show(interaction)
+
+    async def on_timeout(self):
+        if self.message is not None:
+            await self.message.edit(view=None)
+
+
+# Send the first page of a user's history to destination, returns False if there is nothing to show
+async def send_history(destination, user, month=None, command=None):
+    view = HistoryView(user, month, command)
+    await view.load()
+    if not view.rows:
+        return False
+    view.message = await destination.send(embed=view.render(), view=view)
+    return True
+
+
 @bot.command(name='a')
 @commands.check(lambda ctx: has_correct_role(ctx, 'a') and has_permissions(ctx, 'a') and not is_spamming(ctx, 'a'))
-async def add_points(ctx, user: discord.Member, number: float, target_month: str = None, *, timestamp: str = None):
-    target_month = target_month or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+async def add_points(ctx, user: discord.Member, number: parse_amount, target_month: parse_month = None, *, timestamp: str = None):
+    target_month = target_month or current_month_key()
     timestamp = timestamp or target_month
 
-    update_points(user.id, number, 'add', ctx.author.id, target_month)
-    # Fetch the current salary after the update
-    current_salary = cursor.execute('SELECT points FROM user_points WHERE user_id = ?', (user.id,)).fetchone()[0]
-
     # Format target_month to display as "tháng [number] năm [number]"
-    formatted_target_month = datetime.strptime(target_month, '%Y-%m-%d %H:%M:%S').strftime('tháng %m %Y')
+    formatted_target_month = format_month(target_month)
+
+    # update_points returns the salary after the update, the DM is queued in the same transaction
+    current_salary = await update_points(
+        ctx.guild.id, user.id, number, 'add', ctx.author.id, target_month,
+        f"Bạn đã được thêm {number} K vào lương {formatted_target_month}. Lương hiện tại của bạn là {{balance}} K.")
 
     # Send messages
     await ctx.send(f"Lương {formatted_target_month} của {user.mention} là {current_salary} K (Trước đó: {current_salary - number} K).")
-    await user.send(f"Bạn đã được thêm {number} K vào lương {formatted_target_month}. Lương hiện tại của bạn là {current_salary} K.")
 
 @bot.command(name='m')
 @commands.check(lambda ctx: has_correct_role(ctx, 'm') and has_permissions(ctx, 'm') and not is_spamming(ctx, 'm'))
-async def minus_points(ctx, user: discord.Member, number: float, target_month: str = None, *, timestamp: str = None):
-    target_month = target_month or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+async def minus_points(ctx, user: discord.Member, number: parse_amount, target_month: parse_month = None, *, timestamp: str = None):
+    target_month = target_month or current_month_key()
     timestamp = timestamp or target_month
 
-    update_points(user.id, -number, 'minus', ctx.author.id, target_month)
-    # Fetch the current salary after the update
-    current_salary = cursor.execute('SELECT points FROM user_points WHERE user_id = ?', (user.id,)).fetchone()[0]
-    # Send messages
     # Format target_month to display as "tháng [number] năm [number]"
-    formatted_target_month = datetime.strptime(target_month, '%Y-%m-%d %H:%M:%S').strftime('tháng %m  %Y')
-    
+    formatted_target_month = format_month(target_month)
+
+    # update_points returns the salary after the update, the DM is queued in the same transaction
+    current_salary = await update_points(
+        ctx.guild.id, user.id, -number, 'minus', ctx.author.id, target_month,
+        f"Bạn đã bị trừ {number} K khỏi lương {formatted_target_month}. Lương hiện tại của bạn là {{balance}} K.")
+
     # Send messages
     await ctx.send(f"Lương {formatted_target_month} của {user.mention} là {current_salary} K (Trước đó: {current_salary - number} K).")
-    await user.send(f"Bạn đã được thêm {number} K vào lương {formatted_target_month}. Lương hiện tại của bạn là {current_salary} K.")
 
 # ... (code khác)
 
@@ -142,61 +2199,71 @@ async def minus_points(ctx, user: discord.Member, number: float, target_month: s
 
 @bot.command(name='reset')
 @commands.check(lambda ctx: has_correct_role(ctx, 'reset') and has_permissions(ctx, 'reset') and not is_spamming(ctx, 'reset'))
-async def reset_points(ctx, user: discord.Member):
+async def reset_points(ctx, user: discord.Member, mode: str = None):
     current_month = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    
-    # Xóa thông tin lương của người dùng trong cơ sở dữ liệu
-    cursor.execute('DELETE FROM user_points WHERE user_id = ?', (user.id,))
-    cursor.execute('DELETE FROM salary_history WHERE user_id = ?', (user.id,))
-    
-    conn.commit()
+
+    # "!reset @user archive" chuyển lịch sử vào kho lưu trữ thay vì xóa hẳn
+    if mode == 'archive':
+        await reset_user(ctx.guild.id, user.id, "Lương của bạn đã được reset. Lịch sử lương trước đó đã được lưu trữ.", archive=True)
+        await ctx.send(f"Lương của {user.mention} đã được reset, lịch sử đã được lưu trữ.")
+        return
+
+    # Xóa thông tin lương của người dùng trong cơ sở dữ liệu, tin nhắn riêng được xếp hàng cùng lúc
+    await reset_user(ctx.guild.id, user.id, "Lương của bạn đã được reset. Mọi thông tin lương trước đó đã bị xóa.")
 
     # Gửi thông báo lên kênh chat
     await ctx.send(f"Lương của {user.mention} đã được reset.")
 
-    # Gửi tin nhắn riêng cho người dùng được reset
-    await user.send(f"Lương của bạn đã được reset. Mọi thông tin lương trước đó đã bị xóa.")
+MAX_UNDO = 20
+
+
+async def run_undo(ctx, column, target, n, redo):
+    n = max(1, min(n, MAX_UNDO))
+    entries = await undo_operations(ctx.guild.id, column, target.id, n, ctx.author.id, redo)
+    action = 'Redo' if redo else 'Undo'
+    if not entries:
+        await ctx.send(f"{target.mention} không có lệnh nào để {action.lower()}.")
+        return
+    lines = [f"<@{user_id}>: {amount:+} K ({format_month(month)}), lương hiện tại {balance} K" for user_id, amount, month, balance in entries]
+    await ctx.send(f"{action} thành công {len(entries)} lệnh!\n" + '\n'.join(lines))
+
 
 @bot.command(name='undo')
 @commands.check(lambda ctx: has_correct_role(ctx, 'undo') and has_permissions(ctx, 'undo') and not is_spamming(ctx, 'undo'))
-async def undo_last_operation(ctx, user: discord.Member, target_month: str = None):
-    target_month = target_month or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-    # Lấy ra lịch sử lương của người dùng từ cơ sở dữ liệu
-    history = cursor.execute('SELECT * FROM salary_history WHERE user_id = ? AND month = ? ORDER BY timestamp DESC', (user.id, target_month)).fetchall()
-    
-    if history:
-        amount = history['amount']
-        command = history['command']
-
-        if command == 'add':
-            cursor.execute('UPDATE user_points SET points = points - ? WHERE user_id = ?', (amount, user.id))
-        elif command == 'minus':
-            cursor.execute('UPDATE user_points SET points = points + ? WHERE user_id = ?', (amount, user.id))
-
-        # Xóa lịch sử lương cuối cùng của người dùng
-        cursor.execute('DELETE FROM salary_history WHERE user_id = ? AND timestamp = ?', (user.id, history['timestamp']))
-        
-        conn.commit()
-
-        await ctx.send(f"Undo thành công! Lương của {user.mention} đã được khôi phục.")
-    else:
-        await ctx.send(f"{user.mention} không có lệnh nào để undo.")
+async def undo_last_operation(ctx, user: discord.Member, n: int = 1):
+    # Hoàn tác n lệnh cuối cùng của người dùng
+    await run_undo(ctx, 'user_id', user, n, redo=False)
+
+
+@bot.command(name='redo')
+@commands.check(lambda ctx: has_correct_role(ctx, 'redo') and has_permissions(ctx, 'redo') and not is_spamming(ctx, 'redo'))
+async def redo_last_operation(ctx, user: discord.Member, n: int = 1):
+    await run_undo(ctx, 'user_id', user, n, redo=True)
+
+
+@bot.command(name='undo_by')
+@commands.check(lambda ctx: has_correct_role(ctx, 'undo') and has_permissions(ctx, 'undo') and not is_spamming(ctx, 'undo'))
+async def undo_by_executor(ctx, executor: discord.Member, n: int = 1):
+    # Hoàn tác n lệnh cuối cùng do executor thực hiện (với bất kỳ người dùng nào)
+    await run_undo(ctx, 'executor', executor, n, redo=False)
+
+
+@bot.command(name='redo_by')
+@commands.check(lambda ctx: has_correct_role(ctx, 'redo') and has_permissions(ctx, 'redo') and not is_spamming(ctx, 'redo'))
+async def redo_by_executor(ctx, executor: discord.Member, n: int = 1):
+    await run_undo(ctx, 'executor', executor, n, redo=True)
 
 
 @bot.command(name='view')
 @commands.check(lambda ctx: has_correct_role(ctx, 'view') and has_permissions(ctx, 'view') and not is_spamming(ctx, 'view'))
-async def view_salary_history(ctx, user: discord.Member):
-    history = cursor.execute('SELECT * FROM salary_history WHERE user_id = ? ORDER BY timestamp DESC', (user.id,)).fetchall()
-    if history:
-        message = f"Lịch sử lương của {user.mention}:\n"
-        for entry in history:
-            timestamp, amount, command, executor_id, current_salary, target_month = entry[2:8]
-            formatted_target_month = datetime.strptime(target_month, '%Y-%m-%d %H:%M:%S').strftime('tháng %m %Y')
-            message += f"{formatted_target_month}: {command} {amount} K (Tổng lương: {current_salary} K)\n"
-            
-        # Gửi thông điệp riêng tư về lịch sử lương
-        await user.send(message)
+async def view_salary_history(ctx, user: discord.Member, month: typing.Optional[parse_month] = None, command: str = None):
+    # Gửi thông điệp riêng tư về lịch sử lương
+    try:
+        sent = await send_history(user, user, month, command)
+    except discord.Forbidden:
+        await send_warning(ctx, f"Không gửi được tin nhắn riêng cho {user.display_name}.")
+        return
+    if sent:
         await ctx.send(f"Lịch sử lương đã được gửi riêng tư cho {user.mention}.")
     else:
         await ctx.send(f"{user.mention} không có lịch sử lương.")
@@ -204,23 +2271,345 @@ async def view_salary_history(ctx, user: discord.Member):
 
 @bot.command(name='p')
 @commands.check(lambda ctx: has_correct_role(ctx, 'view') and has_permissions(ctx, 'view') and not is_spamming(ctx, 'view'))
-async def view_profile(ctx, user: discord.Member = None):
+async def view_profile(ctx, user: typing.Optional[discord.Member] = None, month: typing.Optional[parse_month] = None, command: str = None):
     user = ctx.author
-    history = cursor.execute('SELECT * FROM salary_history WHERE user_id = ? ORDER BY timestamp DESC', (user.id,)).fetchall()
-    if history:
-        message = f"Lịch sử lương của {user.mention}:\n"
-        for entry in history:
-            timestamp, amount, command, executor_id, current_salary, target_month = entry[2:8]
-            formatted_target_month = datetime.strptime(target_month, '%Y-%m-%d %H:%M:%S').strftime('tháng %m %Y')
-            message += f"{formatted_target_month}: {command} {amount} K (Tổng lương: {current_salary} K)\n"
-            
-        # Gửi thông điệp riêng tư về lịch sử lương
-        await ctx.author.send(message)
+    # Gửi thông điệp riêng tư về lịch sử lương
+    try:
+        sent = await send_history(ctx.author, user, month, command)
+    except discord.Forbidden:
+        await send_warning(ctx, "Không gửi được tin nhắn riêng cho bạn, hãy mở tin nhắn riêng.")
+        return
+    if sent:
         await ctx.send("Lịch sử lương đã được gửi riêng tư cho bạn.")
     else:
         await ctx.send(f"{user.mention} không có lịch sử lương.")
 
 
 
+@bot.command(name='month')
+@commands.check(lambda ctx: has_correct_role(ctx, 'view') and has_permissions(ctx, 'view') and not is_spamming(ctx, 'view'))
+async def view_monthly_totals(ctx, user: discord.Member = None, months: int = 12):
+    user = user or ctx.author
+    rows = await monthly_breakdown(ctx.guild.id, user.id, max(1, min(months, 60)))
+    if not rows:
+        await ctx.send(f"{user.mention} không có lịch sử lương.")
+        return
+    lines = [f"{format_month(month)}: {total} K (+{adds} / -{minuses})" for month, total, adds, minuses in rows]
+    embed = discord.Embed(title=f"Lương theo tháng của {user.display_name}", description='\n'.join(lines))
+    await ctx.send(embed=embed)
+
+
+@bot.command(name='top')
+@commands.check(lambda ctx: has_correct_role(ctx, 'top') and has_permissions(ctx, 'top') and not is_spamming(ctx, 'top'))
+async def view_leaderboard(ctx, month: typing.Optional[parse_month] = None, count: int = 10):
+    month = month or current_month_key()
+    rows = await leaderboard(ctx.guild.id, month, max(1, min(count, 25)))
+    if not rows:
+        await ctx.send(f"Không có dữ liệu lương {format_month(month)}.")
+        return
+    lines = [f"{rank}. <@{user_id}>: {total} K" for rank, (user_id, total) in enumerate(rows, 1)]
+    embed = discord.Embed(title=f"Bảng xếp hạng lương {format_month(month)}", description='\n'.join(lines))
+    await ctx.send(embed=embed)
+
+
+@bot.command(name='rebuild')
+@commands.check(lambda ctx: has_correct_role(ctx, 'rebuild') and has_permissions(ctx, 'rebuild') and not is_spamming(ctx, 'rebuild'))
+async def rebuild_totals(ctx):
+    count = await rebuild_monthly_totals(ctx.guild.id)
+    await ctx.send(f"Đã tính lại tổng lương theo tháng ({count} dòng).")
+
+
+
+# Bulk payroll: "!bulk" followed by one "user amount [month]" per line, or an attached CSV with the same columns
+BULK_MAX_LINES = 1000
+BULK_COLUMNS = ('user', 'amount', 'month')
+
+
+def _resolve_member(guild, token):
+    match = re.fullmatch(r'<@!?(\d+)>|(\d{15,20})', token)
+    if match:
+        return guild.get_member(int(match.group(1) or match.group(2)))
+    return guild.get_member_named(token)
+
+
+def _is_bulk_header(fields):
+    # Only the documented column names make a header, any other first row is data and gets validated
+    names = tuple(field.strip().lower() for field in fields)
+    return len(names) in (2, 3) and names == BULK_COLUMNS[:len(names)]
+
+
+def parse_bulk_rows(guild, executor_id, rows):
+    # rows: (line number, [user, amount, month?]); returns (ops, errors)
+    default_month = current_month_key()
+    ops = []
+    errors = []
+    for line_no, fields in rows:
+        fields = [field.strip() for field in fields]
+        if not any(fields):
+            continue
+        if len(fields) not in (2, 3):
+            errors.append(f"Dòng {line_no}: cần 'user amount [month]'")
+            continue
+        member = _resolve_member(guild, fields[0])
+        if member is None:
+            errors.append(f"Dòng {line_no}: không tìm thấy {fields[0]}")
+            continue
+        try:
+            amount = parse_amount(fields[1])
+        except commands.BadArgument as e:
+            errors.append(f"Dòng {line_no}: {e}")
+            continue
+        if amount == 0:
+            errors.append(f"Dòng {line_no}: số tiền bằng 0")
+            continue
+        try:
+            month = parse_month(fields[2]) if len(fields) == 3 else default_month
+        except commands.BadArgument as e:
+            errors.append(f"Dòng {line_no}: {e}")
+            continue
+        # Several lines for the same user are merged into one DM by the outbox
+        notify = f"Lương {format_month(month)} của bạn đã được cập nhật {amount:+} K. Lương hiện tại của bạn là {{balance}} K."
+        ops.append((member.id, amount, 'add' if amount >= 0 else 'minus', executor_id, month, notify))
+    return ops, errors
+
+
+@bot.command(name='bulk')
+@commands.check(lambda ctx: has_correct_role(ctx, 'bulk') and has_permissions(ctx, 'bulk') and not is_spamming(ctx, 'bulk'))
+async def bulk_payroll(ctx, *, body: str = ''):
+    if ctx.message.attachments:
+        text = (await ctx.message.attachments[0].read()).decode('utf-8-sig')
+        rows = list(enumerate(csv.reader(io.StringIO(text)), 1))
+        # Skip a header row "user,amount[,month]"; any other first row is kept so a bad line is reported, not lost
+        if rows and _is_bulk_header(rows[0][1]):
+            rows = rows[1:]
+    else:
+        rows = [(line_no, line.split()) for line_no, line in enumerate(body.splitlines(), 1)]
+
+    if len(rows) > BULK_MAX_LINES:
+        await send_warning(ctx, f"Tối đa {BULK_MAX_LINES} dòng mỗi lần.")
+        return
+    ops, errors = parse_bulk_rows(ctx.guild, ctx.author.id, rows)
+    if errors:
+        # Validate everything first, nothing is applied if any line is wrong
+        shown = '\n'.join(errors[:10])
+        more = f"\n... và {len(errors) - 10} lỗi khác" if len(errors) > 10 else ''
+        await ctx.send(f"Không áp dụng bảng lương, có {len(errors)} lỗi:\n{shown}{more}")
+        return
+    if not ops:
+        await send_warning(ctx, "Không có dòng nào để áp dụng.")
+        return
+
+    await update_points_many(ctx.guild.id, ops)
+    users = len({op[0] for op in ops})
+    total = sum(op[1] for op in ops)
+    await ctx.send(f"Đã áp dụng {len(ops)} điều chỉnh cho {users} người (tổng {total} K).")
+
+
+
+# "!export [tháng] [csv|json] [gz]" gửi bảng lương của cả tháng dưới dạng 2 tệp đính kèm:
+# tổng lương từng người và toàn bộ lịch sử cộng/trừ trong tháng
+EXPORT_FORMATS = ('csv', 'json')
+
+
+@bot.command(name='export')
+@commands.check(lambda ctx: has_correct_role(ctx, 'export') and has_permissions(ctx, 'export') and not is_spamming(ctx, 'export'))
+async def export_payroll(ctx, month: typing.Optional[parse_month] = None, fmt: str = 'csv', compress: str = None):
+    month = month or current_month_key()
+    fmt = fmt.lower()
+    if fmt not in EXPORT_FORMATS:
+        await ctx.send(f"Định dạng không hợp lệ: {fmt} (chọn {' hoặc '.join(EXPORT_FORMATS)}).")
+        return
+    compress = compress is not None and compress.lower() in ('gz', 'gzip')
+
+    guild = ctx.guild
+
+    def name_of(user_id):
+        member = guild.get_member(user_id) if guild else None
+        return member.display_name if member else ''
+
+    (summary, summary_size), (entries, entries_size) = await export_month(guild.id, month, fmt, compress, name_of)
+    try:
+        limit = guild.filesize_limit if guild else 8 * 1024 * 1024
+        if summary_size + entries_size > limit:
+            hint = "" if compress else " Thử lại với `gz` để nén."
+            await ctx.send(f"Tệp xuất {format_month(month)} quá lớn để gửi ({(summary_size + entries_size) // 1024} KB).{hint}")
+            return
+        suffix = f".{fmt}.gz" if compress else f".{fmt}"
+        name = f"{month // 100}_{month % 100:02d}"
+        files = [discord.File(summary, filename=f"luong_{name}{suffix}"),
+                 discord.File(entries, filename=f"lich_su_{name}{suffix}")]
+        await ctx.send(f"Bảng lương {format_month(month)}.", files=files)
+    finally:
+        summary.close()
+        entries.close()
+
+
+@bot.command(name='stats')
+@commands.check(lambda ctx: has_correct_role(ctx, 'stats') and has_permissions(ctx, 'stats') and not is_spamming(ctx, 'stats'))
+async def view_stats(ctx):
+    def ms(seconds):
+        return f"{seconds * 1000:.1f}"
+
+    embed = discord.Embed(title="Thống kê hiệu năng")
+    busiest = sorted(telemetry.commands.items(), key=lambda item: -item[1].count)[:8]
+    lines = [f"`{name}` x{stats.count}: p50 {ms(p50)} / p95 {ms(p95)} / p99 {ms(p99)} ms"
+             for name, stats in busiest for p50, p95, p99 in [stats.quantiles(0.5, 0.95, 0.99)]]
+    embed.add_field(name="Lệnh", value='\n'.join(lines) or "-", inline=False)
+
+    slowest = sorted(telemetry.queries.items(), key=lambda item: -item[1].total)[:8]
+    lines = [f"`{name}` x{stats.count}: p50 {ms(p50)} / p99 {ms(p99)} ms, chờ p99 {ms(telemetry.query_wait[key].quantiles(0.99)[0])} ms, "
+             f"{telemetry.rows.get(key, 0)} dòng"
+             for key, stats in slowest for name in [key[1]] for p50, p99 in [stats.quantiles(0.5, 0.99)]]
+    embed.add_field(name="Database", value='\n'.join(lines) or "-", inline=False)
+
+    lag_p50, lag_p99 = telemetry.loop_lag.quantiles(0.5, 0.99)
+    store = await get_store(ctx.guild.id)
+    queue = store.write_queue.stats()
+    cache = store.balance_cache.stats()
+    embed.add_field(name="Event loop", value=f"lag p50 {ms(lag_p50)} / p99 {ms(lag_p99)} / max {ms(telemetry.loop_lag.max)} ms")
+    embed.add_field(name="Ghi", value=f"{telemetry.commits} commit, lô TB {queue['avg_batch_size']:.1f}, commit TB {queue['avg_commit_ms']:.1f} ms")
+    embed.add_field(name="Cache", value=f"{cache['size']} user, hit {cache['hit_ratio']:.0%}")
+    embed.add_field(name="Rate limit", value=f"{rate_limiter.throttled} lệnh bị chặn")
+    embed.add_field(name="Outbox", value=', '.join(f"{k} {v}" for k, v in store.outbox.stats().items()))
+    backups = store.backups.stats()
+    embed.add_field(name="Sao lưu", value=f"{backups['completed']} bản, lần cuối {backups['last_seconds']:.1f} s, "
+                                          f"{backups['last_bytes'] // 1024} KB, lỗi {backups['failed']}")
+    await ctx.send(embed=embed)
+
+
+
+# Sao lưu: "!backup" tạo bản sao lưu ngay, "!backup list" liệt kê, "!verify [tên]" kiểm tra,
+# "!restore <tên> [force]" khôi phục (trạng thái hiện tại được sao lưu trước khi bị thay thế).
+# Bản sao lưu hỏng không bao giờ được khôi phục; bản có lương lệch lịch sử chỉ khôi phục khi có "force"
+@bot.group(name='backup', invoke_without_command=True)
+@commands.check(lambda ctx: has_correct_role(ctx, 'backup') and has_permissions(ctx, 'backup') and not is_spamming(ctx, 'backup'))
+async def backup_create(ctx):
+    started = time.perf_counter()
+    name, size = await backup_now(ctx.guild.id)
+    await ctx.send(f"Đã sao lưu `{name}` ({size // 1024} KB) trong {time.perf_counter() - started:.1f} giây.")
+
+
+@backup_create.command(name='list')
+@commands.check(lambda ctx: has_correct_role(ctx, 'backup') and has_permissions(ctx, 'backup') and not is_spamming(ctx, 'backup'))
+async def backup_list(ctx):
+    backups = await list_backups(ctx.guild.id)
+    if not backups:
+        await ctx.send("Chưa có bản sao lưu nào.")
+        return
+    lines = [f"`{name}` ({size // 1024} KB)" for name, size in backups[:25]]
+    await ctx.send(embed=discord.Embed(title="Bản sao lưu", description='\n'.join(lines)))
+
+
+@bot.command(name='verify')
+@commands.check(lambda ctx: has_correct_role(ctx, 'backup') and has_permissions(ctx, 'backup') and not is_spamming(ctx, 'backup'))
+async def backup_verify(ctx, name: str = None):
+    if name is None:
+        backups = await list_backups(ctx.guild.id)
+        if not backups:
+            await ctx.send("Chưa có bản sao lưu nào.")
+            return
+        name = backups[0][0]
+    report = await verify_backup(ctx.guild.id, name)
+    if report is None:
+        await ctx.send(f"Không có bản sao lưu `{name}`.")
+        return
+    status = "OK" if not report['problems'] and not report['mismatched'] else "CÓ LỖI"
+    embed = discord.Embed(title=f"Kiểm tra `{name}`: {status}")
+    embed.add_field(name="Dữ liệu", value=f"{report['users']} người, {report['history']} dòng lịch sử, "
+                                          f"{report['archived']} dòng lưu trữ, phiên bản {report['version']}", inline=False)
+    embed.add_field(name="Lương lệch lịch sử", value=str(report['mismatched']))
+    embed.add_field(name="Integrity", value='\n'.join(report['problems'][:10]) or "ok", inline=False)
+    await ctx.send(embed=embed)
+
+
+@bot.command(name='restore')
+@commands.check(lambda ctx: has_correct_role(ctx, 'restore') and has_permissions(ctx, 'restore') and not is_spamming(ctx, 'restore'))
+async def backup_restore(ctx, name: str, mode: str = None):
+    report = await verify_backup(ctx.guild.id, name)
+    if report is None:
+        await ctx.send(f"Không có bản sao lưu `{name}`.")
+        return
+    if report['problems']:
+        await ctx.send(f"Bản sao lưu `{name}` bị hỏng, không khôi phục.")
+        return
+    if report['mismatched'] and mode != 'force':
+        await ctx.send(f"Bản sao lưu `{name}` có {report['mismatched']} người lương lệch lịch sử, "
+                       f"dùng `!restore {name} force` nếu vẫn muốn khôi phục.")
+        return
+    await restore_store(ctx.guild.id, name)
+    await ctx.send(f"Đã khôi phục dữ liệu từ `{name}` ({report['users']} người, {report['history']} dòng lịch sử).")
+
+
+# "!config" xem và đổi cấu hình của server, chỉ dành cho người có quyền Administrator của server
+# (mỗi lệnh con có check riêng, discord.py không áp check của group cho lệnh con):
+#   !config prefix <prefix>
+#   !config role <lệnh> [@role ...]  (không có role: dùng lại mặc định)
+#   !config limit <lệnh> <số lệnh> <số giây>
+def is_guild_admin(ctx):
+    return ctx.guild is not None and ctx.author.guild_permissions.administrator
+
+
+@bot.group(name='config', invoke_without_command=True)
+@commands.check(is_guild_admin)
+async def config_show(ctx):
+    config = await get_config(ctx.guild.id)
+    embed = discord.Embed(title="Cấu hình server")
+    embed.add_field(name="Prefix", value=f"`{config.prefix}`", inline=False)
+    lines = [f"`{name}`: {' '.join(f'<@&{role_id}>' for role_id in ids) or '-'}" for name, ids in config.role_ids.items()]
+    embed.add_field(name="Role", value='\n'.join(lines), inline=False)
+    lines = [f"`{name}`: {calls} lệnh / {per} giây" for name, (calls, per) in config.rate_limits.items()]
+    embed.add_field(name="Rate limit", value='\n'.join(lines), inline=False)
+    await ctx.send(embed=embed)
+
+
+@config_show.command(name='prefix')
+@commands.check(is_guild_admin)
+async def config_prefix(ctx, prefix: str):
+    if len(prefix) > 5:
+        await ctx.send("Prefix tối đa 5 ký tự.")
+        return
+    await update_config(ctx.guild.id, 'prefix', prefix)
+    await ctx.send(f"Đã đổi prefix thành `{prefix}`.")
+
+
+@config_show.command(name='role')
+@commands.check(is_guild_admin)
+async def config_role(ctx, command_name: str, *roles: discord.Role):
+    if command_name not in role_ids:
+        await ctx.send(f"Không có lệnh `{command_name}`.")
+        return
+    config = await get_config(ctx.guild.id)
+    overrides = {name: ids for name, ids in config.role_ids.items() if ids != role_ids.get(name)}
+    if roles:
+        overrides[command_name] = [role.id for role in roles]
+    else:
+        overrides.pop(command_name, None)
+    await update_config(ctx.guild.id, 'role_ids', overrides)
+    mentions = ' '.join(role.mention for role in roles) or "mặc định"
+    await ctx.send(f"Lệnh `{command_name}` dùng được với: {mentions}.")
+
+
+@config_show.command(name='limit')
+@commands.check(is_guild_admin)
+async def config_limit(ctx, command_name: str, calls: int, seconds: float):
+    if command_name not in rate_limits:
+        await ctx.send(f"Không có lệnh `{command_name}`.")
+        return
+    if calls < 1 or not math.isfinite(seconds) or seconds <= 0:
+        await ctx.send("Số lệnh và số giây phải lớn hơn 0.")
+        return
+    config = await get_config(ctx.guild.id)
+    overrides = {name: limit for name, limit in config.rate_limits.items() if limit != rate_limits.get(name)}
+    overrides[command_name] = (calls, seconds)
+    await update_config(ctx.guild.id, 'rate_limits', overrides)
+    await ctx.send(f"Lệnh `{command_name}`: tối đa {calls} lệnh trong {seconds:g} giây.")
+
+
 # Run the bot
-bot.run('MTIwMzQzNzg1ODY3Nzg1MDIzMg.GXRUPF.bKWJJrAgrN-Sd4t4nbq2RLHqSDZ4HviEgXkG0Y')
\ No newline at end of file
+if __name__ == '__main__':
+    # root_logger: discord.py's log handler also receives this module's records
+    bot.run('MTIwMzQzNzg1ODY3Nzg1MDIzMg.GXRUPF.bKWJJrAgrN-Sd4t4nbq2RLHqSDZ4HviEgXkG0Y', root_logger=True)
+    for store in stores.values():
+        store.db.close()
+    if startup_error:
+        raise SystemExit(startup_error)
\ No newline at end of file